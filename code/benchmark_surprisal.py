@@ -0,0 +1,174 @@
+import os
+import sys
+import argparse
+import json
+import time
+import platform
+import resource
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import torch
+import transformers
+from transformers import AutoTokenizer, AutoModelForCausalLM, GPTNeoXConfig, RwkvConfig, MambaConfig
+import calculate_surprisal
+
+# Measures the throughput of calculate_surprisal.py on small randomly initialised models of
+# each architecture, so that it runs offline on CPU and the transformer and recurrent code
+# paths can be compared on equal terms. Options given after '--' (e.g. -- --batch_size 8
+# --precision bfloat16) are passed on to calculate_surprisal.py.
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks the throughput of calculate_surprisal.py \
+                                    with small randomly initialised models')
+
+    parser.add_argument('--stimuli_directory', '-sd', type=str, default='../cleaned_stimuli',
+                        help='directory of .stims files to benchmark on (default is ../cleaned_stimuli)')
+    parser.add_argument('--sample_size', '-n', type=int, default=200,
+                        help='number of lines from the start of each stimulus file to score (default is 200; 0 uses all lines)')
+    parser.add_argument('--architectures', '-a', type=str, default='pythia,rwkv,mamba',
+                        help='comma-separated architectures to benchmark (default is pythia,rwkv,mamba)')
+    parser.add_argument('--tokenizer', '-tok', type=str, default='EleutherAI/pythia-70m',
+                        help='tokenizer to use for all architectures (default is EleutherAI/pythia-70m, which Pythia, RWKV and Mamba share)')
+    parser.add_argument('--max_length', '-ml', type=int, default=2048,
+                        help='maximum context length of the transformer models (default is 2048)')
+    parser.add_argument('--hidden_size', '-hs', type=int, default=128,
+                        help='hidden size of the models (default is 128)')
+    parser.add_argument('--num_layers', '-nl', type=int, default=4,
+                        help='number of layers of the models (default is 4)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for initialising the models (default is 0)')
+    parser.add_argument('--output', '-o', type=str, default='benchmark_results.json',
+                        help='path of the json file to save the results to (default is benchmark_results.json)')
+    parser.add_argument('--baseline', '-bl', type=str,
+                        help='path of a json file of earlier results to compare against')
+
+    argv = sys.argv[1:]
+    surprisal_argv = []
+    if "--" in argv:
+        argv, surprisal_argv = argv[:argv.index("--")], argv[argv.index("--")+1:]
+    args = parser.parse_args(argv)
+    return args, surprisal_argv
+
+def get_model_config(architecture,vocab_size,args):
+    if architecture=="pythia":
+        return GPTNeoXConfig(vocab_size=vocab_size,hidden_size=args.hidden_size,num_hidden_layers=args.num_layers,
+                             num_attention_heads=max(1,args.hidden_size//64),intermediate_size=4*args.hidden_size,
+                             max_position_embeddings=args.max_length)
+    elif architecture=="rwkv":
+        return RwkvConfig(vocab_size=vocab_size,hidden_size=args.hidden_size,num_hidden_layers=args.num_layers,
+                          attention_hidden_size=args.hidden_size,intermediate_size=4*args.hidden_size,
+                          context_length=args.max_length)
+    elif architecture=="mamba":
+        return MambaConfig(vocab_size=vocab_size,hidden_size=args.hidden_size,num_hidden_layers=args.num_layers)
+
+def load_tokenizer(args):
+    return calculate_surprisal.prepare_tokenizer(AutoTokenizer.from_pretrained(args.tokenizer))
+
+def run_benchmark(architecture,stimulus_file_list,args,surprisal_argv,work_directory):
+    # runs in its own process, so that the peak memory is that of this architecture alone
+    torch.manual_seed(args.seed)
+    tokenizer = load_tokenizer(args)
+    model_directory = os.path.join(work_directory,architecture+"_model")
+    AutoModelForCausalLM.from_config(get_model_config(architecture,len(tokenizer),args)).save_pretrained(model_directory)
+
+    output_directory = os.path.join(work_directory,architecture+"_output")
+    arg_dict = calculate_surprisal.process_args(calculate_surprisal.parse_args(
+        ["-o",output_directory,"-m",architecture,"-t","surprisal","-i",stimulus_file_list[0]]+surprisal_argv))
+
+    start_time = time.time()
+    model = calculate_surprisal.prepare_model(AutoModelForCausalLM.from_pretrained(model_directory),arg_dict)
+    load_seconds = time.time()-start_time
+
+    reversed_tokenizer, tokenizer_hash = calculate_surprisal.get_tokenizer_vocabulary(tokenizer)
+    stimulus_results = []
+    for stimulus_file in stimulus_file_list:
+        arg_dict["stimulus_file_list"] = [stimulus_file]
+        start_time = time.time()
+        calculate_surprisal.process_stims(model,tokenizer,"causal","benchmark__"+architecture,arg_dict)
+        seconds = time.time()-start_time
+        # the target tokens are counted outside the timed run
+        with open(stimulus_file,'r') as f:
+            stimulus_list = f.read().splitlines()
+        encoded_stimuli = [encoded for encoded in calculate_surprisal.get_encoded_stimuli(stimulus_list,tokenizer,reversed_tokenizer,tokenizer_hash,arg_dict["token_cache"])
+                           if encoded is not None]
+        stimulus_results.append({"stimuli":os.path.basename(stimulus_file),"num_stimuli":len(encoded_stimuli),
+                                 "num_tokens":sum([len(encoded["target_words"]) for encoded in encoded_stimuli]),"seconds":seconds})
+
+    num_stimuli = sum([stimulus_result["num_stimuli"] for stimulus_result in stimulus_results])
+    num_tokens = sum([stimulus_result["num_tokens"] for stimulus_result in stimulus_results])
+    seconds = sum([stimulus_result["seconds"] for stimulus_result in stimulus_results])
+    return {"num_parameters":sum([parameter.numel() for parameter in model.parameters()]),
+            "load_seconds":load_seconds,
+            "seconds":seconds,
+            "num_stimuli":num_stimuli,
+            "num_tokens":num_tokens,
+            "stimuli_per_second":num_stimuli/seconds if seconds>0 else None,
+            "tokens_per_second":num_tokens/seconds if seconds>0 else None,
+            # ru_maxrss is in kilobytes on Linux
+            "peak_rss_mb":resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,
+            "stimulus_files":stimulus_results}
+
+def get_stimulus_samples(args,work_directory):
+    # the first sample_size lines of each stimulus file, which keeps the documents of
+    # document-level files intact
+    stimulus_file_list = []
+    for stimulus_file_name in sorted(os.listdir(args.stimuli_directory)):
+        if not stimulus_file_name.endswith(".stims"):
+            continue
+        with open(os.path.join(args.stimuli_directory,stimulus_file_name),'r') as f:
+            stimulus_list = f.read().splitlines()
+        if args.sample_size>0:
+            stimulus_list = stimulus_list[:args.sample_size]
+        sample_filename = os.path.join(work_directory,stimulus_file_name)
+        with open(sample_filename,'w') as f:
+            f.write("\n".join(stimulus_list)+"\n")
+        stimulus_file_list.append(sample_filename)
+    return stimulus_file_list
+
+def print_comparison(results,baseline):
+    print("\nArchitecture\tTokens/s\tBaseline\tRatio\tPeakRSS(MB)\tBaseline\tLoad(s)\tBaseline")
+    for architecture in results:
+        if not architecture in baseline:
+            continue
+        current, previous = results[architecture], baseline[architecture]
+        ratio = current["tokens_per_second"]/previous["tokens_per_second"] if current["tokens_per_second"] and previous["tokens_per_second"] else float("nan")
+        print("{0}\t{1:.1f}\t{2:.1f}\t{3:.2f}\t{4:.0f}\t{5:.0f}\t{6:.2f}\t{7:.2f}".format(
+            architecture,current["tokens_per_second"] or 0,previous["tokens_per_second"] or 0,ratio,
+            current["peak_rss_mb"],previous["peak_rss_mb"],current["load_seconds"],previous["load_seconds"]))
+
+def main():
+    args, surprisal_argv = parse_args()
+    results = dict()
+    with tempfile.TemporaryDirectory() as work_directory:
+        stimulus_file_list = get_stimulus_samples(args,work_directory)
+        if not stimulus_file_list:
+            print("Error: No .stims files found in {0}".format(args.stimuli_directory))
+            return
+        for architecture in args.architectures.split(","):
+            try:
+                with ProcessPoolExecutor(max_workers=1,mp_context=multiprocessing.get_context("spawn")) as executor:
+                    results[architecture] = executor.submit(run_benchmark,architecture,stimulus_file_list,args,surprisal_argv,work_directory).result()
+            except:
+                print("Cannot benchmark {0}".format(architecture))
+                continue
+            print("{0}: {1:.1f} tokens/s, {2:.1f} stimuli/s, peak RSS {3:.0f} MB, model load {4:.2f}s".format(
+                architecture,results[architecture]["tokens_per_second"] or 0,results[architecture]["stimuli_per_second"] or 0,
+                results[architecture]["peak_rss_mb"],results[architecture]["load_seconds"]))
+
+    settings = dict(vars(args))
+    settings.update({"surprisal_arguments":surprisal_argv,"torch":torch.__version__,"transformers":transformers.__version__,
+                     "num_threads":torch.get_num_threads(),"cpu_count":os.cpu_count(),"platform":platform.platform()})
+    with open(args.output,"w") as f:
+        json.dump({"settings":settings,"results":results},f,indent=2)
+
+    if args.baseline:
+        try:
+            with open(args.baseline,"r") as f:
+                baseline = json.load(f)["results"]
+            print_comparison(results,baseline)
+        except:
+            print("Error: Cannot read baseline results from {0}".format(args.baseline))
+
+if __name__ == "__main__":
+    main()
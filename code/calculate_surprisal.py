@@ -1,16 +1,29 @@
 import os
 import argparse
 from transformers import AutoTokenizer,AutoModelForCausalLM,AutoModelForMaskedLM, AutoConfig
+from transformers import MODEL_FOR_MASKED_LM_MAPPING, MODEL_FOR_CAUSAL_LM_MAPPING
 from torch.nn import functional as F
 import torch
 import numpy as np
 import copy
 import re
+import inspect
+import importlib.util
+import json
+import hashlib
+import time
+import multiprocessing
+import cProfile
+import traceback
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from huggingface_hub import list_models
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, Counter
+import results_store
+import stimulus_reader
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description='Calculates surprisal and other \
                                     metrics (in development) of transformers language models')
 
@@ -31,15 +44,57 @@ def parse_args():
     parser.add_argument('--model_revision_list','-rr', type=str,
                         help='path to file with a list which revision of the model to use')                        
     parser.add_argument('--task', '-t', type=str,
-                        help='metric to caclulate')
+                        help='metric to caclulate (surprisal, token_surprisal, entropy, renyi or top_k_mass)')
     parser.add_argument('--task_list', '-tt', type=str,
                         help='path to file with list of metrics to caclulate')
+    parser.add_argument('--renyi_alpha', type=float, default=0.5,
+                        help='order of the Renyi entropy metric (default is 0.5)')
+    parser.add_argument('--top_k', type=int, default=10,
+                        help='number of most probable tokens summed in the top_k_mass metric (default is 10)')
     parser.add_argument('--following_context', '-f', action="store_true", default=False,
                         help='whether or not consider the following context with masked language models (default is False)')
     parser.add_argument('--use_cpu', '-cpu', action="store_true", default=False,
                         help='use CPU for models even if CUDA is available')
+    parser.add_argument('--precision', '-p', type=str, default='float32',
+                        help='precision to run models in: float32, bfloat16, or int8 (dynamic quantization of linear layers, CPU only) (default is float32)')
+    parser.add_argument('--fidelity_check', '-fc', type=int, default=0,
+                        help='number of lines of each stimulus file to also score in float32 when running at a lower precision, reporting the deviation in surprisal (default is 0, i.e. no check)')
+    parser.add_argument('--no_recurrent_state', '-nrs', action="store_true", default=False,
+                        help='run recurrent models (RWKV, Mamba) over the full context for each stimulus instead of carrying over their recurrent state')
+    parser.add_argument('--kv_cache_size', '-kv', type=float, default=0,
+                        help='memory budget in MB for reusing the key/value caches of shared prefixes across stimuli with transformer models (default is 0, i.e. disabled)')
+    parser.add_argument('--window_stride', '-ws', type=int, default=0,
+                        help='number of tokens that the window moves by when scoring contexts longer than a transformer model can take (default is 0, i.e. half of the maximum length)')
+    parser.add_argument('--batch_size', '-b', type=int, default=1,
+                        help='number of stimuli (or documents) of similar length to run through the model at once (default is 1)')
+    parser.add_argument('--model_cache_size', '-mc', type=float, default=0,
+                        help='memory in GB for keeping loaded models between the runs of a process (e.g. the jobs of a parallel worker) (default is 0, i.e. models are not kept)')
+    parser.add_argument('--num_workers', '-w', type=int, default=1,
+                        help='number of worker processes to run model x revision jobs (each over all of the stimulus files) in parallel (default is 1, i.e. run serially)')
+    parser.add_argument('--memory_budget', '-mb', type=float,
+                        help='total memory in GB that parallel jobs may use, based on estimated model sizes (default is 80%% of system memory)')
+    parser.add_argument('--job_log', '-jl', type=str,
+                        help='path to a tsv file in which to record the timing of each parallel job')
+    parser.add_argument('--resume', action="store_true", default=False,
+                        help='resume interrupted runs from their last checkpoint and skip stimulus files that are already complete')
+    parser.add_argument('--checkpoint_every', '-ce', type=int, default=500,
+                        help='number of stimuli to score between flushing the output files to disk and recording progress (default is 500)')
+    parser.add_argument('--shard', '-sh', type=str,
+                        help='score only shard i of N of each stimulus file, given as i/N (shards are made of whole documents and written to a shards folder in the output directory, to be combined with merge_shards.py; with the default batch size of 1, the merged files are the same as those of an unsharded run)')
+    parser.add_argument('--results_store', '-rs', type=str,
+                        help='path of a partitioned Parquet results store to also write the results into (requires pyarrow)')
+    parser.add_argument('--trace', '-tr', type=str,
+                        help='path to a jsonl file in which to record the time spent in each phase (loading, encoding, forward passes, metrics, decoding, writing) and the latency of scoring each stimulus')
+    parser.add_argument('--profile', type=str,
+                        help='profile each model with cprofile or torch, saving the profiles in a profiles folder in the output directory')
+    parser.add_argument('--token_cache', '-tc', type=str,
+                        help='directory in which to cache the encoded stimuli of each tokenizer (default is .token_cache in the output directory)')
+    parser.add_argument('--perplexity_data', '-pd', type=str,
+                        help='path to a local copy of the WikiText test set (wiki.test.raw from wikitext-2-raw-v1) on which to also calculate the word-level perplexity of each causal model (without stimuli, only the perplexity is calculated)')
+    parser.add_argument('--perplexity_output', '-po', type=str, default='../statistics/calculated_perplexities.tsv',
+                        help='path of the tsv file in which to record the perplexity of each model (default is ../statistics/calculated_perplexities.tsv, so that the lm_eval perplexities in perplexities.tsv are kept)')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
 def process_args(args):
@@ -79,6 +134,136 @@ def process_args(args):
     except:
         print("Error: 'use_cpu' argument must be Boolean.")
         return None
+
+    try:
+        precision = args.precision
+        assert precision in ["float32","bfloat16","int8"]
+        arg_dict["precision"] = precision
+    except:
+        print("Error: Please select 'float32', 'bfloat16', or 'int8' for precision argument.")
+        return None
+
+    try:
+        fidelity_check = int(args.fidelity_check)
+        assert fidelity_check>=0
+        arg_dict["fidelity_check"] = fidelity_check if precision!="float32" else 0
+    except:
+        print("Error: 'fidelity_check' argument must be a non-negative integer.")
+        return None
+
+    try:
+        use_recurrent_state = not args.no_recurrent_state
+        assert type(use_recurrent_state)==bool
+        arg_dict["use_recurrent_state"] = use_recurrent_state
+    except:
+        print("Error: 'no_recurrent_state' argument must be Boolean.")
+        return None
+
+    try:
+        kv_cache_size = float(args.kv_cache_size)
+        assert kv_cache_size>=0
+        arg_dict["kv_cache_size"] = kv_cache_size
+    except:
+        print("Error: 'kv_cache_size' argument must be a non-negative number of MB.")
+        return None
+
+    try:
+        window_stride = int(args.window_stride)
+        assert window_stride>=0
+        arg_dict["window_stride"] = window_stride
+    except:
+        print("Error: 'window_stride' argument must be a non-negative integer.")
+        return None
+
+    try:
+        batch_size = int(args.batch_size)
+        assert batch_size>=1
+        arg_dict["batch_size"] = batch_size
+    except:
+        print("Error: 'batch_size' argument must be a positive integer.")
+        return None
+
+    try:
+        model_cache_size = float(args.model_cache_size)*1024**3
+        assert model_cache_size>=0
+        arg_dict["model_cache_size"] = model_cache_size
+    except:
+        print("Error: 'model_cache_size' argument must be a non-negative number of GB.")
+        return None
+
+    try:
+        num_workers = int(args.num_workers)
+        assert num_workers>=1
+        arg_dict["num_workers"] = num_workers
+    except:
+        print("Error: 'num_workers' argument must be a positive integer.")
+        return None
+
+    try:
+        if args.memory_budget:
+            memory_budget = float(args.memory_budget)*1024**3
+        else:
+            memory_budget = 0.8*os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_PHYS_PAGES")
+        assert memory_budget>0
+        arg_dict["memory_budget"] = memory_budget
+    except:
+        print("Error: 'memory_budget' argument must be a positive number of GB.")
+        return None
+
+    arg_dict["job_log"] = args.job_log
+
+    try:
+        resume = args.resume
+        assert type(resume)==bool
+        arg_dict["resume"] = resume
+    except:
+        print("Error: 'resume' argument must be Boolean.")
+        return None
+
+    try:
+        checkpoint_every = int(args.checkpoint_every)
+        assert checkpoint_every>=1
+        arg_dict["checkpoint_every"] = checkpoint_every
+    except:
+        print("Error: 'checkpoint_every' argument must be a positive integer.")
+        return None
+
+    if args.shard:
+        try:
+            arg_dict["shard"] = stimulus_reader.parse_shard(args.shard)
+        except:
+            print("Error: 'shard' argument must be given as i/N, with 1 <= i <= N.")
+            return None
+
+    if args.results_store:
+        try:
+            import pyarrow
+            arg_dict["results_store"] = args.results_store
+        except:
+            print("Error: 'results_store' requires pyarrow to be installed.")
+            return None
+
+    arg_dict["trace"] = args.trace
+
+    try:
+        assert args.profile in [None,"cprofile","torch"]
+        arg_dict["profile"] = args.profile
+    except:
+        print("Error: Please select either 'cprofile' or 'torch' for profile argument.")
+        return None
+
+    arg_dict["token_cache"] = args.token_cache if args.token_cache else os.path.join(output_directory,".token_cache")
+
+    if args.perplexity_data:
+        try:
+            assert os.path.exists(args.perplexity_data)
+            arg_dict["perplexity_data"] = args.perplexity_data
+            arg_dict["perplexity_output"] = args.perplexity_output
+        except:
+            print("Error: 'perplexity_data' argument does not have a valid path.")
+            return None
+    # with perplexity data but no stimuli, neither stimuli nor metrics are needed
+    perplexity_only = arg_dict["perplexity_data"] is not None and not args.stimuli and not args.stimuli_list
     
     
     if args.model_list:
@@ -128,8 +313,8 @@ def process_args(args):
                 return None
     else:
         try:
-            assert args.task
-            task_list = [args.task]
+            assert args.task or perplexity_only
+            task_list = [args.task] if args.task else []
         except:
             print("Error: No metric specified")   
             return None 
@@ -158,16 +343,35 @@ def process_args(args):
     arg_dict["model_revision_list"] = model_revision_list
 
     for i in range(len(task_list)):
-        if task_list[i] in ["surprisal"]:
+        if task_list[i] in metric_definitions:
             if not "standard_metric_list" in arg_dict:
                 arg_dict["standard_metric_list"] = []
             arg_dict["standard_metric_list"].append(task_list[i])
-    if not arg_dict["standard_metric_list"]:
+    if not arg_dict["standard_metric_list"] and not perplexity_only:
         print("No valid metrics specified")
         return None
+
+    try:
+        renyi_alpha = float(args.renyi_alpha)
+        assert renyi_alpha>0 and renyi_alpha!=1
+        arg_dict["renyi_alpha"] = renyi_alpha
+    except:
+        print("Error: 'renyi_alpha' argument must be a positive number other than 1.")
+        return None
+
+    try:
+        top_k = int(args.top_k)
+        assert top_k>=1
+        arg_dict["top_k"] = top_k
+    except:
+        print("Error: 'top_k' argument must be a positive integer.")
+        return None
             
             
-    if args.stimuli_list:
+    if perplexity_only:
+        stimulus_file_list = []
+        arg_dict["stimulus_file_list"] = []
+    elif args.stimuli_list:
         try:
             assert os.path.exists(args.stimuli_list)
             with open(args.stimuli_list, "r") as f:
@@ -201,152 +405,1174 @@ def process_args(args):
                 
     return(arg_dict)  
 
+def get_token_surprisals(log_probability_distribution,target_words,arg_dict):
+    return -log_probability_distribution[torch.arange(len(target_words)),target_words]
+
+def get_token_entropies(log_probability_distribution,target_words,arg_dict):
+    return -torch.sum(torch.exp(log_probability_distribution)*log_probability_distribution,dim=-1)
+
+def get_token_renyi_entropies(log_probability_distribution,target_words,arg_dict):
+    alpha = arg_dict["renyi_alpha"]
+    return torch.logsumexp(alpha*log_probability_distribution,dim=-1)/(1-alpha)
+
+def get_token_top_k_masses(log_probability_distribution,target_words,arg_dict):
+    top_k = min(arg_dict["top_k"],log_probability_distribution.shape[-1])
+    return torch.sum(torch.exp(torch.topk(log_probability_distribution,top_k,dim=-1).values),dim=-1)
+
+# each metric is computed from the log-probability distributions at the target positions
+# (one row per target token) as one value per target token, and is then written either as the
+# sum over the target tokens, as the value at the first target token (i.e. before the start
+# of the target words), or as the list of values for all target tokens
+metric_definitions = {
+    "surprisal":{"name":"Surprisal","function":get_token_surprisals,"aggregation":"sum"},
+    "token_surprisal":{"name":"TokenSurprisals","function":get_token_surprisals,"aggregation":"list"},
+    "entropy":{"name":"Entropy","function":get_token_entropies,"aggregation":"first"},
+    "renyi":{"name":"RenyiEntropy","function":get_token_renyi_entropies,"aggregation":"first"},
+    "top_k_mass":{"name":"TopKMass","function":get_token_top_k_masses,"aggregation":"first"},
+}
+
 def get_metric_name(metric_name):
-    if metric_name=="surprisal":
-        return "Surprisal"
+    return metric_definitions[metric_name]["name"]
 
         
 
-def create_and_run_models(arg_dict):
+def prepare_tokenizer(tokenizer):
+    if (not tokenizer.bos_token) and (tokenizer.cls_token):
+        tokenizer.bos_token = tokenizer.cls_token
+    if (not tokenizer.eos_token) and (tokenizer.sep_token):
+        tokenizer.eos_token = tokenizer.sep_token
+
+    tokenizer.add_special_tokens({"additional_special_tokens":["[!StimulusMarker!]"]})
+    return tokenizer
+
+def prepare_model(model,arg_dict):
+    # moves the model to its device and converts it to the requested precision; dynamic int8
+    # quantization of the linear layers is only supported on CPU
+    model = model.to(get_device(arg_dict))
+    if arg_dict["precision"]=="bfloat16":
+        model = model.to(torch.bfloat16)
+    elif arg_dict["precision"]=="int8":
+        # one forward pass first, so that weights adjusted on the first call (e.g. the layer
+        # rescaling of RWKV) are adjusted before they are quantized
+        with torch.no_grad():
+            model(torch.LongTensor([[0]]))
+        # the output layer stays in float32, as some models read its weights directly
+        output_layer = model.get_output_embeddings()
+        quantized_layers = {name:torch.ao.quantization.default_dynamic_qconfig for name, module in model.named_modules()
+                            if isinstance(module,torch.nn.Linear) and module is not output_layer}
+        model = torch.ao.quantization.quantize_dynamic(model,quantized_layers,dtype=torch.qint8)
+    return model
+
+def get_precision_model_name(model_name_cleaned,precision):
+    # lower-precision results are written under their own model name, keeping the revision
+    # (if any) at the end
+    if precision=="float32":
+        return model_name_cleaned
+    model_name_parts = model_name_cleaned.split("___")
+    model_name_parts[0] = "{0}-{1}".format(model_name_parts[0],precision)
+    return "___".join(model_name_parts)
+
+def run_fidelity_check(model,reference_model,tokenizer,model_type,model_name_cleaned,arg_dict):
+    # scores a random sample of the lines of each stimulus file with both the lower-precision
+    # model and the float32 reference model and reports how much their surprisals differ
+    reversed_tokenizer, tokenizer_hash = get_tokenizer_vocabulary(tokenizer)
+    metric_dict = {"surprisal":[]}
+    for stimulus_file in arg_dict["stimulus_file_list"]:
+        stimuli_name = stimulus_file.split('/')[-1].split('.')[0]
+        with open(stimulus_file,'r') as f:
+            stimulus_list = f.read().splitlines()
+        encoded_stimuli = get_encoded_stimuli(stimulus_list,tokenizer,reversed_tokenizer,tokenizer_hash,arg_dict["token_cache"])
+        valid_lines = [j for j in range(len(encoded_stimuli)) if encoded_stimuli[j] is not None]
+        sample_size = min(arg_dict["fidelity_check"],len(valid_lines))
+        line_idxs = sorted(np.random.RandomState(0).choice(valid_lines,sample_size,replace=False).tolist())
+        metric_values = score_stimuli(model,tokenizer,model_type,encoded_stimuli,line_idxs,metric_dict,arg_dict,dict())
+        reference_metric_values = score_stimuli(reference_model,tokenizer,model_type,encoded_stimuli,line_idxs,metric_dict,arg_dict,dict())
+        deviations = [abs(aggregate_metric_values("surprisal",metric_values[j]["surprisal"])-aggregate_metric_values("surprisal",reference_metric_values[j]["surprisal"]))
+                      for j in line_idxs if j in metric_values and j in reference_metric_values]
+        if deviations:
+            print("Fidelity check of {0} on {1} ({2} lines): max surprisal deviation {3:.4f}, mean {4:.4f}".format(
+                model_name_cleaned,stimuli_name,len(deviations),np.max(deviations),np.mean(deviations)))
+        else:
+            print("Fidelity check of {0} on {1}: no lines could be scored".format(model_name_cleaned,stimuli_name))
+
+def get_model_type(config,primary_decoder):
+    # decides from the config alone whether the model is run as a masked or a causal language
+    # model, preferring primary_decoder when the model has both forms
+    has_masked_form = type(config) in MODEL_FOR_MASKED_LM_MAPPING
+    has_causal_form = type(config) in MODEL_FOR_CAUSAL_LM_MAPPING
+    if primary_decoder=="masked":
+        if has_masked_form:
+            return "masked"
+        elif has_causal_form:
+            return "causal"
+    elif primary_decoder=="causal":
+        if has_causal_form:
+            if config.architectures and "Masked" in config.architectures[0]:
+                return "causal_mask"
+            return "causal"
+        elif has_masked_form:
+            return "masked"
+    return None
+
+def get_device(arg_dict):
+    return "cuda" if (torch.cuda.is_available() and not arg_dict["use_cpu"] and arg_dict["precision"]!="int8") else "cpu"
+
+def load_pretrained_model(model_name,revision,config,model_type,torch_dtype,device):
+    # safetensors checkpoints are memory-mapped and, with accelerate installed, their weights
+    # are read straight into the model on its device instead of into a randomly initialised
+    # float32 copy first
+    model_kwargs = {"config":config,"torch_dtype":torch_dtype}
+    if revision!='[!latest!]':
+        model_kwargs["revision"] = str(revision)
+    if importlib.util.find_spec("accelerate") is not None:
+        model_kwargs["low_cpu_mem_usage"] = True
+        model_kwargs["device_map"] = device
+    if model_type=="masked":
+        model = AutoModelForMaskedLM.from_pretrained(model_name,**model_kwargs)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_name,**model_kwargs)
+    return model.to(device)
+
+def get_model_size(model):
+    return sum([tensor.nelement()*tensor.element_size() for tensor in list(model.parameters())+list(model.buffers())])
+
+# tokenizers (with their reversed vocabularies and hashes) by model name, and models ready to
+# run (on their device, at their precision) by model name, revision, decoder and precision;
+# models are kept up to a memory budget (--model_cache_size), least recently used first out
+loaded_tokenizers = dict()
+model_cache = {"models":OrderedDict(),"size":0,"memory_budget":0}
+
+def load_tokenizer(model_name):
+    if not model_name in loaded_tokenizers:
+        slow_tokenizer_list = ["facebook/opt","open_llama"]
+        fast_tok = True
+        for slow_tok_model in slow_tokenizer_list:
+            if slow_tok_model in model_name:
+                fast_tok = False
+        with timed("tokenizer_load"):
+            tokenizer = prepare_tokenizer(AutoTokenizer.from_pretrained(model_name,use_fast=fast_tok))
+            loaded_tokenizers[model_name] = {"tokenizer":tokenizer,
+                                             "reversed_tokenizer":{v: k for k, v in tokenizer.get_vocab().items()},
+                                             "tokenizer_hash":get_tokenizer_hash(tokenizer)}
+    return loaded_tokenizers[model_name]["tokenizer"]
+
+def get_tokenizer_vocabulary(tokenizer):
+    # the reversed vocabulary and hash of a tokenizer, computed once per loaded tokenizer
+    for tokenizer_entry in loaded_tokenizers.values():
+        if tokenizer_entry["tokenizer"] is tokenizer:
+            return tokenizer_entry["reversed_tokenizer"], tokenizer_entry["tokenizer_hash"]
+    return {v: k for k, v in tokenizer.get_vocab().items()}, get_tokenizer_hash(tokenizer)
+
+def load_model(model_name,revision,arg_dict):
+    # returns the model (ready to run) and its type, from the model cache if possible
+    cache_key = (model_name,str(revision),arg_dict["primary_decoder"],arg_dict["precision"],get_device(arg_dict))
+    if cache_key in model_cache["models"]:
+        model_cache["models"].move_to_end(cache_key)
+        record_count("model_cache_hits",1)
+        return model_cache["models"][cache_key]["model"], model_cache["models"][cache_key]["model_type"]
+
+    with timed("model_load"):
+        config_kwargs = dict() if revision=='[!latest!]' else {"revision":str(revision)}
+        config = AutoConfig.from_pretrained(model_name,**config_kwargs)
+        model_type = get_model_type(config,arg_dict["primary_decoder"])
+        if model_type is None:
+            raise ValueError("Model {0} is not a masked or causal language model".format(model_name))
+        if model_type!="masked":
+            config.is_decoder = True
+        # int8 models are quantized from float32 on the CPU
+        torch_dtype = torch.bfloat16 if arg_dict["precision"]=="bfloat16" else torch.float32
+        model = prepare_model(load_pretrained_model(model_name,revision,config,model_type,torch_dtype,get_device(arg_dict)),arg_dict)
+
+    model_size = get_model_size(model)
+    if model_size<=model_cache["memory_budget"]:
+        model_cache["models"][cache_key] = {"model":model,"model_type":model_type,"size":model_size}
+        model_cache["size"] += model_size
+        while model_cache["size"]>model_cache["memory_budget"]:
+            evicted_key, evicted_entry = model_cache["models"].popitem(last=False)
+            model_cache["size"] -= evicted_entry["size"]
+    return model, model_type
+
+def run_model(model,tokenizer,model_type,model_name,revision,model_name_cleaned,arg_dict):
+    # scores the stimuli and, with perplexity data, returns the perplexity row of the model
+    model_name_cleaned = get_precision_model_name(model_name_cleaned,arg_dict["precision"])
+    write_trace_record({"event":"model_load","model":model_name_cleaned,"model_type":model_type})
+    if arg_dict["fidelity_check"]:
+        # the float32 reference model is loaded for the check only, and never cached
+        config_kwargs = dict() if revision=='[!latest!]' else {"revision":str(revision)}
+        config = AutoConfig.from_pretrained(model_name,**config_kwargs)
+        if model_type!="masked":
+            config.is_decoder = True
+        reference_model = load_pretrained_model(model_name,revision,config,model_type,torch.float32,model.device)
+        run_fidelity_check(model,reference_model,tokenizer,model_type,model_name_cleaned,arg_dict)
+        del(reference_model)
+        write_trace_record({"event":"fidelity_check","model":model_name_cleaned,"model_type":model_type})
+
+    if arg_dict["profile"]:
+        profile_directory = os.path.join(arg_dict["output_directory"],"profiles")
+        os.makedirs(profile_directory,exist_ok=True)
+    if arg_dict["profile"]=="cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            process_stims(model,tokenizer,model_type,model_name_cleaned,arg_dict)
+        finally:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(profile_directory,model_name_cleaned+".prof"))
+    elif arg_dict["profile"]=="torch":
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if model.device.type=="cuda":
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        with torch.profiler.profile(activities=activities) as profiler:
+            process_stims(model,tokenizer,model_type,model_name_cleaned,arg_dict)
+        profiler.export_chrome_trace(os.path.join(profile_directory,model_name_cleaned+".trace.json"))
+    else:
+        process_stims(model,tokenizer,model_type,model_name_cleaned,arg_dict)
 
-# convert to "try causal mask" approach
+    if arg_dict["perplexity_data"]:
+        perplexity = calculate_perplexity(model,tokenizer,model_type,arg_dict)
+        write_trace_record({"event":"perplexity","model":model_name_cleaned,"model_type":model_type})
+        if perplexity is not None:
+            print("WikiText word perplexity of {0}: {1:.4f}".format(model_name_cleaned,perplexity))
+            return {"ModelName":get_perplexity_model_name(model_name,revision,arg_dict["precision"]),"Perplexity":perplexity}
+    return None
+
+def create_and_run_models(arg_dict):
 
-    slow_tokenizer_list = ["facebook/opt","open_llama"]
+    instrumentation["trace"] = arg_dict["trace"]
+    model_cache["memory_budget"] = arg_dict["model_cache_size"]
+    perplexities = []
 
     for revision in arg_dict["model_revision_list"]:
+        for model_name in arg_dict["model_list"]:
 
-        if arg_dict["primary_decoder"] == "masked":
-            for model_name in arg_dict["model_list"]:
-                
-                if 'tokenizer' in locals():
-                    del(tokenizer)
-                
-                if 'model' in locals():
-                    del(model)
-                    
-                fast_tok = True
+            model_name_cleaned = model_name.replace("/","__").replace(".","_")
 
-                for slow_tok_model in slow_tokenizer_list:
-                    if slow_tok_model in model_name:
-                        fast_tok = False
+            if revision!='[!latest!]':
+                model_name_cleaned = "{0}___{1}".format(model_name_cleaned,str(revision))
+
+            try:
+                tokenizer = load_tokenizer(model_name)
+            except:
+                print("Cannot create a tokenizer for model {0}: {1}".format(model_name,record_error("load_tokenizer")))
+                write_trace_record({"event":"model_load","model":model_name_cleaned,"model_type":None})
+                continue
 
-                model_name_cleaned = model_name.replace("/","__").replace(".","_")
+            try:
+                model, model_type = load_model(model_name,revision,arg_dict)
+            except:
+                print("Cannot load model {0} as a masked or causal language model: {1}".format(model_name,record_error("load_model")))
+                write_trace_record({"event":"model_load","model":model_name_cleaned,"model_type":None})
+                continue
 
-                if revision!='[!latest!]':
-                    model_name_cleaned = "{0}___{1}".format(model_name_cleaned,str(revision))
+            try:
+                perplexity_row = run_model(model,tokenizer,model_type,model_name,revision,model_name_cleaned,arg_dict)
+                if perplexity_row:
+                    perplexities.append(perplexity_row)
+                    if arg_dict["perplexity_output"]:
+                        save_perplexities(arg_dict["perplexity_output"],[perplexity_row])
+            except:
+                print("Cannot run either a masked or causal form of {0}: {1}".format(model_name,record_error("run_model")))
+                write_trace_record({"event":"run_model","model":model_name_cleaned,"model_type":model_type})
+            del(model)
 
-                try:
-                    tokenizer = AutoTokenizer.from_pretrained(model_name,use_fast=fast_tok)
-                    
-                    if (not tokenizer.bos_token) and (tokenizer.cls_token):
-                        tokenizer.bos_token = tokenizer.cls_token
-                    if (not tokenizer.eos_token) and (tokenizer.sep_token):
-                        tokenizer.eos_token = tokenizer.sep_token
+    return perplexities
 
-                    tokenizer.add_special_tokens({"additional_special_tokens":["[!StimulusMarker!]"]})
 
-                except:
-                    print("Cannot create a tokenizer for model {0}".format(model_name))
-                    
+def estimate_model_memory(model_name,revision,arg_dict):
+    # rough memory needed to run a model, from its config if it can be loaded
+    # and otherwise from the parameter count in its name (e.g. pythia-1.4b, rwkv-4-1b5-pile)
+    num_parameters = None
+    try:
+        if revision!='[!latest!]':
+            config = AutoConfig.from_pretrained(model_name,revision=str(revision))
+        else:
+            config = AutoConfig.from_pretrained(model_name)
+        hidden_size = config.hidden_size
+        num_layers = config.num_hidden_layers
+        # parameters per layer as a multiple of hidden_size squared
+        layer_multiple = {"rwkv":13,"mamba":7}.get(config.model_type,12)
+        num_parameters = config.vocab_size*hidden_size*2 + num_layers*layer_multiple*hidden_size**2
+    except:
+        size_match = re.search(r"(\d+)(?:[\._](\d+))?([mb])(\d*)(?![a-z])",model_name.split("/")[-1].lower())
+        if size_match:
+            whole, fraction, unit, trailing = size_match.groups()
+            size = float(whole + "." + (fraction or trailing or "0"))
+            num_parameters = size*(1e9 if unit=="b" else 1e6)
+    if num_parameters is None:
+        num_parameters = 1e9
+    # int8 models are quantized from a float32 copy, and the fidelity check keeps one
+    bytes_per_parameter = (2 if arg_dict["precision"]=="bfloat16" else 4) + (4 if arg_dict["fidelity_check"] else 0)
+    return num_parameters*bytes_per_parameter*1.25
+
+def init_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+def get_job_stimuli(job):
+    return ",".join(job["stimulus_file_list"]) or job["perplexity_data"]
+
+def run_job(job):
+    job_arg_dict = defaultdict(lambda:None)
+    job_arg_dict.update(job)
+    start_time = time.time()
+    instrumentation["job_errors"] = []
+    perplexities = create_and_run_models(job_arg_dict)
+    return {"Model":job["model_list"][0],"Revision":job["model_revision_list"][0],"Stimuli":get_job_stimuli(job),
+            "EstimatedMemoryGB":job["estimated_memory"]/1024**3,"Start":start_time,"Seconds":time.time()-start_time,"Worker":os.getpid(),
+            "Perplexities":perplexities,"Errors":instrumentation["job_errors"]}
+
+def run_scheduled_jobs(arg_dict):
+    # expands revisions x models into jobs, each scoring all of the stimulus files so that every
+    # checkpoint is only loaded once, and runs them over a process pool, starting the largest
+    # jobs first and only starting a job when its estimated memory fits within the memory budget
+    # alongside the jobs already running; the perplexity of each model is saved here, rather
+    # than by the workers
+    jobs = []
+    for revision in arg_dict["model_revision_list"]:
+        for model_name in arg_dict["model_list"]:
+            job = dict(arg_dict)
+            job["model_list"] = [model_name]
+            job["model_revision_list"] = [revision]
+            job["estimated_memory"] = estimate_model_memory(model_name,revision,arg_dict)
+            job["perplexity_output"] = None
+            jobs.append(job)
+    jobs = sorted(jobs,key=lambda job:-job["estimated_memory"])
+
+    num_threads = max(1,(os.cpu_count() or 1)//arg_dict["num_workers"])
+    job_timings = []
+    running = dict()
+    used_memory = 0
+    with ProcessPoolExecutor(max_workers=arg_dict["num_workers"],mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_worker,initargs=(num_threads,)) as executor:
+        while jobs or running:
+            for job in list(jobs):
+                if len(running)>=arg_dict["num_workers"]:
+                    break
+                # a job too large for the budget still runs, but only on its own
+                if running and used_memory+job["estimated_memory"]>arg_dict["memory_budget"]:
+                    continue
+                job["submitted"] = time.time()
+                running[executor.submit(run_job,job)] = job
+                used_memory += job["estimated_memory"]
+                jobs.remove(job)
+            finished, _ = wait(list(running),return_when=FIRST_COMPLETED)
+            for future in finished:
+                job = running.pop(future)
+                used_memory -= job["estimated_memory"]
                 try:
-                    if revision!='[!latest!]':
-                        config = AutoConfig.from_pretrained(model_name,revision=str(revision))
-                        # see https://github.com/EleutherAI/lm-evaluation-harness/issues/1269
-                        model = AutoModelForMaskedLM.from_pretrained(model_name,revision=str(revision), torch_dtype=torch.float32)
-                        model_type = "masked"
-                    else:
-                        config = AutoConfig.from_pretrained(model_name)
-                        model = AutoModelForMaskedLM.from_pretrained(model_name, torch_dtype=torch.float32)
-                        model_type = "masked"
+                    job_timing = future.result()
+                    job_timings.append(job_timing)
+                    if job_timing["Perplexities"]:
+                        save_perplexities(arg_dict["perplexity_output"],job_timing["Perplexities"])
+                    print("Finished {0} ({1}) on {2} in {3:.1f}s".format(job_timing["Model"],job_timing["Revision"],job_timing["Stimuli"],job_timing["Seconds"]))
                 except:
-                    try:
-                        if revision!='[!latest!]':
-                            config = AutoConfig.from_pretrained(model_name,is_decoder=True,revision=str(revision))
-                            model = AutoModelForCausalLM.from_pretrained(model_name,is_decoder=True,revision=str(revision), torch_dtype=torch.float32)
-                            model_type = "causal"
-                        else:
-                            config = AutoConfig.from_pretrained(model_name,is_decoder=True)
-                            model = AutoModelForCausalLM.from_pretrained(model_name,is_decoder=True, torch_dtype=torch.float32)
-                            model_type = "causal"
-                    except:
-                        print("Model {0} is not a masked or causal language model. This is not supported".format(model_name))
-                try:
+                    # the traceback includes that of the worker
+                    error_traceback = traceback.format_exc()
+                    print("Job for {0} on {1} failed: {2}".format(job["model_list"][0],get_job_stimuli(job),
+                                                                  error_traceback.strip().split("\n")[-1]))
+                    job_timings.append({"Model":job["model_list"][0],"Revision":job["model_revision_list"][0],
+                                        "Stimuli":get_job_stimuli(job),
+                                        "EstimatedMemoryGB":job["estimated_memory"]/1024**3,"Start":job["submitted"],
+                                        "Seconds":time.time()-job["submitted"],"Worker":"",
+                                        "Errors":[{"where":"job","traceback":error_traceback}]})
 
-                    assert model and tokenizer
-                    if model and tokenizer:
-                        try:
-                            process_stims(model.to("cuda" if (torch.cuda.is_available() and not arg_dict["use_cpu"]) else "cpu"),tokenizer,model_type,model_name_cleaned,arg_dict)
-                        except:
-                            print("Cannot run either a masked or causal form of {0}".format(model_name))
-                except:
-                    print("Cannot run experiment without both a tokenizer for and a causal or masked form of {0}".format(model_name))
-        
-        elif arg_dict["primary_decoder"] == "causal":
-            for model_name in arg_dict["model_list"]:
+    if arg_dict["job_log"]:
+        # with the number of errors in each job and the first traceback (on one line)
+        with open(arg_dict["job_log"],"w") as f:
+            f.write("Model\tRevision\tStimuli\tEstimatedMemoryGB\tStart\tSeconds\tWorker\tErrors\tError\n")
+            for job_timing in sorted(job_timings,key=lambda job_timing:job_timing["Start"]):
+                first_error = job_timing["Errors"][0]["traceback"].replace("\n","\\n").replace("\t","\\t") if job_timing["Errors"] else ""
+                f.write("{Model}\t{Revision}\t{Stimuli}\t{EstimatedMemoryGB}\t{Start}\t{Seconds}\t{Worker}\t{1}\t{0}\n".format(first_error,len(job_timing["Errors"]),**job_timing))
 
-                if 'tokenizer' in locals():
-                    del(tokenizer)
-                
-                if 'model' in locals():
-                    del(model)
+# time spent in each phase, latencies of scoring each stimulus, token counts and the tracebacks
+# of handled errors, which are only collected when a trace file is given; scheduled jobs also
+# collect the tracebacks of their errors for the job log
+instrumentation = {"trace":None,"phases":defaultdict(lambda:[0.0,0]),"latencies":[],"counts":defaultdict(int),"errors":[],"job_errors":None}
+max_recorded_errors = 20
 
-                fast_tok = True
-                for slow_tok_model in slow_tokenizer_list:
-                    if slow_tok_model in model_name:
-                        fast_tok = False
-                
-                model_name_cleaned = model_name.replace("/","__").replace(".","_")
+def record_phase(phase,seconds):
+    if instrumentation["trace"] is None:
+        return
+    instrumentation["phases"][phase][0] += seconds
+    instrumentation["phases"][phase][1] += 1
+
+@contextmanager
+def timed(phase):
+    if instrumentation["trace"] is None:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(phase,time.perf_counter()-start_time)
 
-                if revision!='[!latest!]':
-                    model_name_cleaned = "{0}___{1}".format(model_name_cleaned,str(revision))
+def record_count(name,count):
+    if instrumentation["trace"] is not None:
+        instrumentation["counts"][name] += count
 
-                try:
-                    tokenizer = AutoTokenizer.from_pretrained(model_name,use_fast=fast_tok)
-                    
-                    if (not tokenizer.bos_token) and (tokenizer.cls_token):
-                        tokenizer.bos_token = tokenizer.cls_token
-                    if (not tokenizer.eos_token) and (tokenizer.sep_token):
-                        tokenizer.eos_token = tokenizer.sep_token
+def record_error(where):
+    # called from the handler of an error that is skipped or only printed; returns the last line
+    # of the traceback, and only the first max_recorded_errors tracebacks are kept
+    error_traceback = traceback.format_exc()
+    error = {"where":where,"traceback":error_traceback}
+    record_count("errors",1)
+    if instrumentation["trace"] is not None and len(instrumentation["errors"])<max_recorded_errors:
+        instrumentation["errors"].append(error)
+    if instrumentation["job_errors"] is not None and len(instrumentation["job_errors"])<max_recorded_errors:
+        instrumentation["job_errors"].append(error)
+    return error_traceback.strip().split("\n")[-1]
 
-                    tokenizer.add_special_tokens({"additional_special_tokens":["[!StimulusMarker!]"]})
+def record_latencies(seconds,num_stimuli):
+    # the time taken to run the model for a stimulus; stimuli scored together (in a batch or
+    # a prefix chain) are each given an equal share of the time taken
+    if instrumentation["trace"] is not None and num_stimuli>0:
+        instrumentation["latencies"].extend([seconds/num_stimuli]*num_stimuli)
 
-                except:
-                    print("Cannot create a tokenizer for model {0}".format(model_name))
-                    
-                try:
-                    if revision!='[!latest!]':
-                        model = AutoModelForCausalLM.from_pretrained(model_name,is_decoder=True,revision=str(revision))
-                        model_type = "causal"
-                        if "Masked" in model.config.architectures[0]:
-                            model_type = "causal_mask"         
-                    else:            
-                        model = AutoModelForCausalLM.from_pretrained(model_name,is_decoder=True)
-                        model_type = "causal"
-                        if "Masked" in model.config.architectures[0]:
-                            model_type = "causal_mask"                    
-                except:
-                    try:
-                        if revision!='[!latest!]':
-                            model = AutoModelForMaskedLM.from_pretrained(model_name,revision=str(revision))
-                            model_type = "masked"
-                        else:
-                            model = AutoModelForMaskedLM.from_pretrained(model_name)
-                            model_type = "masked"
-                    except:
-                        print("Model {0} is not a causal or masked language model. This is not supported".format(model_name))
-                try:
-                    assert model and tokenizer
-                    if model and tokenizer:
-                        try:
-                            process_stims(model.to("cuda" if (torch.cuda.is_available() and not arg_dict["use_cpu"]) else "cpu"),tokenizer,model_type,model_name_cleaned,arg_dict)
-                        except:
-                            print("Cannot run either a causal or masked form of {0}".format(model_name))
-                except:
-                    print("Cannot run experiment without both a tokenizer for and a causal or masked form of {0}".format(model_name))  
+def write_trace_record(record):
+    # adds the phases, latencies and counts collected since the last record, and resets them
+    if instrumentation["trace"] is None:
+        return
+    record["pid"] = os.getpid()
+    record["time"] = time.time()
+    record["phases"] = {phase:{"seconds":seconds,"calls":calls} for phase, (seconds, calls) in instrumentation["phases"].items()}
+    record["counts"] = dict(instrumentation["counts"])
+    if instrumentation["latencies"]:
+        latencies_ms = np.array(instrumentation["latencies"])*1000
+        bin_edges = [0,0.1,0.2,0.5,1,2,5,10,20,50,100,200,500,1000,2000,5000,float("inf")]
+        record["latency_ms"] = {"mean":float(np.mean(latencies_ms)),
+                                "p50":float(np.percentile(latencies_ms,50)),
+                                "p90":float(np.percentile(latencies_ms,90)),
+                                "p99":float(np.percentile(latencies_ms,99)),
+                                "max":float(np.max(latencies_ms)),
+                                "histogram":{"bin_edges":bin_edges[:-1],"counts":np.histogram(latencies_ms,bins=bin_edges)[0].tolist()}}
+    if instrumentation["errors"]:
+        record["errors"] = instrumentation["errors"]
+    # one write per record, so that records from parallel workers are not interleaved
+    with open(instrumentation["trace"],"a") as f:
+        f.write(json.dumps(record)+"\n")
+    instrumentation["phases"].clear()
+    instrumentation["counts"].clear()
+    instrumentation["latencies"] = []
+    instrumentation["errors"] = []
+
+def run_forward(model,input,**model_kwargs):
+    with timed("forward"):
+        with torch.no_grad():
+            output = model(input, return_dict=True, **model_kwargs)
+        if instrumentation["trace"] is not None and output.logits.is_cuda:
+            torch.cuda.synchronize()
+    record_count("forward_tokens",input.numel())
+    return output
+
+def get_max_length(model,tokenizer):
+    # recurrent models are not limited in how much context they can take
+    if is_recurrent_model(model):
+        return float("inf")
+    # otherwise by the positions in the model's config; tokenizers that do not set a maximum
+    # length (such as Pythia's) report a placeholder of about 1e30, which is ignored
+    max_lengths = [getattr(model.config,name) for name in ["max_position_embeddings","n_positions","n_ctx"]
+                   if isinstance(getattr(model.config,name,None),int)]
+    if tokenizer.model_max_length<1e20:
+        max_lengths.append(tokenizer.model_max_length)
+    return min(max_lengths) if max_lengths else tokenizer.model_max_length
+
+def get_window_stride(max_length,arg_dict):
+    if arg_dict["window_stride"]:
+        return min(arg_dict["window_stride"],max_length)
+    return max(1,max_length//2)
+
+def get_context_windows(num_positions,first_position,max_length,stride):
+    # splits the positions from first_position onwards into windows (start, end, first scored
+    # position) of at most max_length tokens, each moving stride tokens past the previous one
+    # and scoring only the positions the previous one did not reach; the tokens they share
+    # serve as context, so positions after the first window see at least max_length-stride
+    # tokens, at a cost linear in num_positions
+    windows = []
+    window_end = min(num_positions,max(max_length,first_position+stride))
+    score_start = first_position
+    while True:
+        windows.append((max(0,window_end-max_length),window_end,score_start))
+        if window_end>=num_positions:
+            break
+        score_start = window_end
+        window_end = min(num_positions,window_end+stride)
+    return windows
+
+def get_causal_target_logits(model,preceding_context,target_words,max_length,stride):
+    # teacher-forced: one forward pass over the context and targets, reading each target's
+    # prediction from the shifted logits; sequences longer than max_length are scored over
+    # sliding windows (see get_context_windows)
+    input_ids = preceding_context + target_words[:-1]
+    target_logits = []
+    for window_start, window_end, score_start in get_context_windows(len(input_ids),len(preceding_context)-1,max_length,stride):
+        input = torch.LongTensor([input_ids[window_start:window_end]]).to(model.device)
+        logits = run_forward(model,input).logits[0]
+        target_logits.append(logits[score_start-window_start:])
+    return torch.cat(target_logits)
+
+def get_masked_input(context,following_words,tokenizer,include_following_context,max_length):
+    # the context, a mask token, the following words (if included) and an end token; if this
+    # is longer than max_length, the start of the context (after its first token) is dropped
+    # first, and then the end of the following words
+    if len(context)+2>max_length:
+        context = context[:1] + context[len(context)-(max_length-3):]
+    if include_following_context==True:
+        following_words = following_words[:max(0,max_length-len(context)-2)]
+        return context + [tokenizer.mask_token_id] + following_words + [tokenizer.eos_token_id]
+    return context + [tokenizer.mask_token_id] + [tokenizer.eos_token_id]
+
+def get_masked_inputs(encoded,tokenizer,include_following_context,max_length):
+    # one masked input per target sub-token, which is predicted from the context plus the
+    # preceding sub-tokens
+    return [get_masked_input(encoded["preceding_context"]+encoded["target_words"][:k],encoded["following_words"],tokenizer,include_following_context,max_length)
+            for k in range(len(encoded["target_words"]))]
+
+def get_context_lengths(encoded,tokenizer,model_type,max_length,arg_dict):
+    # how many tokens the prediction of each target token was conditioned on
+    preceding_context = encoded["preceding_context"]
+    target_words = encoded["target_words"]
+    if model_type=="causal":
+        context_lengths = []
+        for window_start, window_end, score_start in get_context_windows(len(preceding_context)+len(target_words)-1,len(preceding_context)-1,max_length,get_window_stride(max_length,arg_dict)):
+            context_lengths = context_lengths + [position-window_start+1 for position in range(score_start,window_end)]
+        return context_lengths
+    return [len(model_input_list)-1 for model_input_list in get_masked_inputs(encoded,tokenizer,arg_dict["include_following_context"],max_length)]
+
+def run_padded_batch(model,sequences,pad_token_id):
+    # right-pads the sequences into one batch and returns the logits (batch x length x vocab);
+    # with right padding, the outputs at the real positions of each sequence are unaffected by
+    # the padding in causal models, and padding is masked out for the others
+    max_length = max([len(sequence) for sequence in sequences])
+    input_ids = [sequence + [pad_token_id]*(max_length-len(sequence)) for sequence in sequences]
+    attention_mask = [[1]*len(sequence) + [0]*(max_length-len(sequence)) for sequence in sequences]
+    input = torch.LongTensor(input_ids).to(model.device)
+    if is_recurrent_model(model) or min([len(sequence) for sequence in sequences])==max_length:
+        return run_forward(model,input).logits
+    return run_forward(model,input,attention_mask=torch.LongTensor(attention_mask).to(model.device)).logits
+
+def get_pad_token_id(tokenizer):
+    for token_id in [tokenizer.pad_token_id,tokenizer.eos_token_id,tokenizer.bos_token_id]:
+        if token_id is not None:
+            return token_id
+    return 0
+
+def get_length_buckets(lengths,batch_size):
+    # groups indices into batches of similar length, so that little of each batch is padding
+    order = sorted(range(len(lengths)),key=lambda idx:lengths[idx])
+    return [order[k:k+batch_size] for k in range(0,len(order),batch_size)]
+
+def score_masked_batch(model,tokenizer,masked_input_batch,input_counts,shared_logits):
+    # the masked inputs of all the target sub-tokens of the stimuli in the batch are run in one
+    # padded forward pass, each distinct input once, and the logits at their mask positions are
+    # gathered together; input_counts has how many more times each input is needed, and the
+    # logits of inputs that are needed again by later batches (e.g. stimuli with the same
+    # context and different targets) are kept in shared_logits until their last use
+    input_idxs = dict()
+    distinct_inputs = []
+    for masked_inputs in masked_input_batch:
+        for model_input_list in masked_inputs:
+            input_key = tuple(model_input_list)
+            if not input_key in shared_logits and not input_key in input_idxs:
+                input_idxs[input_key] = len(distinct_inputs)
+                distinct_inputs.append(model_input_list)
+    if distinct_inputs:
+        logits = run_padded_batch(model,distinct_inputs,get_pad_token_id(tokenizer))
+        mask_idxs = torch.LongTensor([model_input_list.index(tokenizer.mask_token_id) for model_input_list in distinct_inputs]).to(logits.device)
+        distinct_logits = logits[torch.arange(len(distinct_inputs),device=logits.device),mask_idxs]
+    target_logits = []
+    for masked_inputs in masked_input_batch:
+        logits_list = []
+        for model_input_list in masked_inputs:
+            input_key = tuple(model_input_list)
+            logits_list.append(distinct_logits[input_idxs[input_key]] if input_key in input_idxs else shared_logits[input_key])
+            input_counts[input_key] -= 1
+            if input_counts[input_key]>0:
+                shared_logits[input_key] = logits_list[-1]
+            else:
+                shared_logits.pop(input_key,None)
+        target_logits.append(torch.stack(logits_list) if logits_list else None)
+    return target_logits
+
+def get_prefix_chains(encoded_stimuli,line_idxs,document_ids=None):
+    # document-level stimulus files store each document as a chain of lines, each of which
+    # is the previous line plus one more target; consecutive lines (of the same document, if
+    # document_ids is given) whose preceding context is exactly the previous line's context
+    # plus its targets are grouped into one chain
+    prefix_chains = []
+    previous = None
+    previous_j = None
+    for j in line_idxs:
+        encoded = encoded_stimuli[j]
+        if encoded is None:
+            previous = None
+            continue
+        if previous is not None and previous_j==j-1 and (document_ids is None or document_ids[j]==document_ids[previous_j]) and encoded["preceding_context"]==previous["preceding_context"]+previous["target_words"]:
+            prefix_chains[-1].append(j)
+        else:
+            prefix_chains.append([j])
+        previous = encoded
+        previous_j = j
+    return prefix_chains
+
+def score_causal_chains(model,encoded_stimuli,prefix_chains,max_length,stride,batch_size,pad_token_id):
+    # all lines of a chain that fit in the model are read off a single forward pass over the
+    # longest of them, with up to batch_size chains of similar length run together; any
+    # longer lines are scored individually
+    chain_inputs = []
+    chain_lines = []
+    long_lines = []
+    for prefix_chain in prefix_chains:
+        fitting_lines = []
+        for j in prefix_chain:
+            encoded = encoded_stimuli[j]
+            if len(encoded["preceding_context"])+len(encoded["target_words"])-1 <= max_length:
+                fitting_lines.append(j)
+        if fitting_lines:
+            longest = encoded_stimuli[fitting_lines[-1]]
+            chain_inputs.append((longest["preceding_context"] + longest["target_words"])[:-1])
+            chain_lines.append(fitting_lines)
+        long_lines = long_lines + prefix_chain[len(fitting_lines):]
+
+    # lines of a batch that fails are not yielded
+    for bucket in get_length_buckets([len(input_ids) for input_ids in chain_inputs],batch_size):
+        start_time = time.perf_counter()
+        try:
+            logits = run_padded_batch(model,[chain_inputs[c] for c in bucket],pad_token_id)
+        except:
+            record_error("causal_batch")
+            continue
+        record_latencies(time.perf_counter()-start_time,sum([len(chain_lines[c]) for c in bucket]))
+        for row in range(len(bucket)):
+            for j in chain_lines[bucket[row]]:
+                target_start = len(encoded_stimuli[j]["preceding_context"])-1
+                yield j, logits[row, target_start:target_start+len(encoded_stimuli[j]["target_words"])]
+
+    for j in long_lines:
+        encoded = encoded_stimuli[j]
+        start_time = time.perf_counter()
+        try:
+            target_logits = get_causal_target_logits(model,encoded["preceding_context"],encoded["target_words"],max_length,stride)
+        except:
+            record_error("causal_windows")
+            continue
+        record_latencies(time.perf_counter()-start_time,1)
+        yield j, target_logits
+
+def is_recurrent_model(model):
+    return model.config.model_type in ["rwkv","mamba"]
+
+def run_recurrent_model(model,input_ids,recurrent_cache):
+    # feeds input_ids to the model starting from the state in recurrent_cache (updated in
+    # place), and returns the logits for each of the input tokens
+    if model.config.model_type=="rwkv":
+        input = torch.LongTensor([input_ids]).to(model.device)
+        output = run_forward(model,input,state=recurrent_cache["state"],use_cache=True)
+        recurrent_cache["state"] = output.state
+        recurrent_cache["consumed"] = recurrent_cache["consumed"] + input_ids
+        return output.logits[0]
+
+    elif model.config.model_type=="mamba":
+        # after the first call, the Mamba cache can only be advanced one token at a time
+        if recurrent_cache["state"] is None:
+            token_groups = [input_ids]
+        else:
+            token_groups = [[token] for token in input_ids]
+        uses_cache_position = "cache_position" in inspect.signature(model.forward).parameters
+        logits = []
+        for token_group in token_groups:
+            input = torch.LongTensor([token_group]).to(model.device)
+            model_kwargs = {"use_cache":True}
+            if recurrent_cache["state"] is not None:
+                model_kwargs["cache_params"] = recurrent_cache["state"]
+                if uses_cache_position:
+                    # positions below conv_kernel would be written into the wrong slot of the convolution state
+                    model_kwargs["cache_position"] = torch.LongTensor([max(len(recurrent_cache["consumed"]),model.config.conv_kernel)]).to(model.device)
+            output = run_forward(model,input,**model_kwargs)
+            recurrent_cache["state"] = output.cache_params
+            recurrent_cache["consumed"] = recurrent_cache["consumed"] + token_group
+            logits.append(output.logits[0])
+        return torch.cat(logits)
+
+def reset_recurrent_cache(recurrent_cache):
+    recurrent_cache["state"] = None
+    recurrent_cache["consumed"] = []
+    recurrent_cache["last_logits"] = None
+    recurrent_cache["snapshot"] = None
+
+def score_recurrent_stimulus(model,encoded,next_encoded,recurrent_cache):
+    # keeps the recurrent state (RWKV state, Mamba cache_params) between tokens and between
+    # consecutive stimuli, so that a stimulus extending the tokens already read only costs
+    # its new tokens; the state at the end of a preceding context is also kept when the next
+    # stimulus starts with the same context but does not extend this one
+    preceding_context = encoded["preceding_context"]
+    target_words = encoded["target_words"]
+    full_sequence = preceding_context + target_words
+
+    consumed = recurrent_cache["consumed"]
+    if not (len(consumed)<=len(preceding_context) and preceding_context[:len(consumed)]==consumed):
+        snapshot = recurrent_cache["snapshot"]
+        reset_recurrent_cache(recurrent_cache)
+        if snapshot and len(snapshot["consumed"])<=len(preceding_context) and preceding_context[:len(snapshot["consumed"])]==snapshot["consumed"]:
+            recurrent_cache.update(copy.deepcopy(snapshot))
+
+    new_context = preceding_context[len(recurrent_cache["consumed"]):]
+    if len(new_context)>0:
+        recurrent_cache["last_logits"] = run_recurrent_model(model,new_context,recurrent_cache)[-1]
+
+    if next_encoded is not None:
+        next_preceding_context = next_encoded["preceding_context"]
+        if next_preceding_context[:len(preceding_context)]==preceding_context and next_preceding_context[:len(full_sequence)]!=full_sequence:
+            recurrent_cache["snapshot"] = copy.deepcopy({"state":recurrent_cache["state"],"consumed":recurrent_cache["consumed"],"last_logits":recurrent_cache["last_logits"]})
+        else:
+            recurrent_cache["snapshot"] = None
+
+    if len(target_words)==0:
+        return None
+    output_logits = run_recurrent_model(model,target_words,recurrent_cache)
+    target_logits = torch.cat([recurrent_cache["last_logits"].unsqueeze(0),output_logits[:-1]])
+    recurrent_cache["last_logits"] = output_logits[-1]
+    return target_logits
+
+def get_tensor_size(obj):
+    if torch.is_tensor(obj):
+        return obj.nelement()*obj.element_size()
+    elif isinstance(obj,(list,tuple)):
+        return sum([get_tensor_size(item) for item in obj])
+    elif isinstance(obj,dict):
+        return sum([get_tensor_size(item) for item in obj.values()])
+    elif hasattr(obj,"__dict__"):
+        return sum([get_tensor_size(item) for item in vars(obj).values()])
+    return 0
+
+def create_prefix_cache(memory_budget):
+    # a trie over token prefixes whose nodes can hold the past_key_values (and the logits
+    # of the last token) for that prefix; entries are evicted least recently used first
+    # once memory_budget (in bytes) is exceeded, and nodes left without an entry or children
+    # are removed, so that every leaf holds an entry
+    return {"root":{"children":dict(),"entry":None,"parent":None,"token":None},
+            "entries":OrderedDict(),"size":0,"memory_budget":memory_budget,"hits":0,"misses":0}
+
+def clear_prefix_cache(prefix_cache):
+    # removes all entries, keeping the counts of hits and misses
+    prefix_cache["root"] = {"children":dict(),"entry":None,"parent":None,"token":None}
+    prefix_cache["entries"] = OrderedDict()
+    prefix_cache["size"] = 0
+
+def lookup_prefix_cache(prefix_cache,tokens):
+    # returns the longest prefix of tokens that the cache covers, as (length, entry): either a
+    # cached prefix itself or the start of a longer cached sequence that shares it (e.g. the
+    # same sentence with a different ending), whose past_key_values then have to be cropped to
+    # length; a longer sequence is found by following any path down from the last shared node,
+    # as every leaf holds an entry
+    node = prefix_cache["root"]
+    cached_length, cached_node = 0, None
+    shared_length = 0
+    for k in range(len(tokens)):
+        if not tokens[k] in node["children"]:
+            break
+        node = node["children"][tokens[k]]
+        shared_length = k+1
+        if node["entry"] is not None:
+            cached_length, cached_node = k+1, node
+    if shared_length>cached_length:
+        while node["entry"] is None:
+            node = next(iter(node["children"].values()))
+        cached_length, cached_node = shared_length, node
+    if cached_node is None:
+        return 0, None
+    prefix_cache["entries"].move_to_end(id(cached_node))
+    return cached_length, cached_node["entry"]
+
+def evict_prefix_cache_entry(prefix_cache):
+    node_id, node = prefix_cache["entries"].popitem(last=False)
+    prefix_cache["size"] -= node["entry"]["size"]
+    node["entry"] = None
+    while node["parent"] is not None and node["entry"] is None and not node["children"]:
+        del node["parent"]["children"][node["token"]]
+        node = node["parent"]
+
+def insert_prefix_cache(prefix_cache,tokens,past_key_values,last_logits):
+    entry = {"past_key_values":past_key_values,"last_logits":last_logits,"length":len(tokens)}
+    entry["size"] = get_tensor_size(entry)
+    if entry["size"]>prefix_cache["memory_budget"]:
+        return
+    node = prefix_cache["root"]
+    for token in tokens:
+        if not token in node["children"]:
+            node["children"][token] = {"children":dict(),"entry":None,"parent":node,"token":token}
+        node = node["children"][token]
+    if node["entry"] is not None:
+        prefix_cache["size"] -= node["entry"]["size"]
+    node["entry"] = entry
+    prefix_cache["entries"][id(node)] = node
+    prefix_cache["entries"].move_to_end(id(node))
+    prefix_cache["size"] += entry["size"]
+    while prefix_cache["size"]>prefix_cache["memory_budget"]:
+        evict_prefix_cache_entry(prefix_cache)
+
+def crop_past_key_values(past_key_values,length):
+    # a copy of the past_key_values of the first length tokens of a longer cached sequence, or
+    # None if they are not in a layout that can be cropped
+    if hasattr(past_key_values,"crop"):
+        past_key_values = copy.deepcopy(past_key_values)
+        past_key_values.crop(length)
+        return past_key_values
+    if not isinstance(past_key_values,tuple):
+        return None
+    # legacy caches are (key, value) tensors per layer, with the sequence as the second-to-last
+    # dimension
+    layer_tensors = [tensor for layer in past_key_values for tensor in layer]
+    if not all([torch.is_tensor(tensor) and tensor.dim()==4 for tensor in layer_tensors]) or len(set([tensor.shape[-2] for tensor in layer_tensors]))!=1:
+        return None
+    return tuple([tuple([tensor[..., :length, :].clone() for tensor in layer]) for layer in past_key_values])
+
+def score_cached_stimulus(model,encoded,prefix_cache,max_length,stride):
+    # only the part of the stimulus not covered by the longest cached prefix of its preceding
+    # context is run through the model; the caches at the end of the preceding context and
+    # at the end of the stimulus are then stored for the stimuli that follow
+    preceding_context = encoded["preceding_context"]
+    target_words = encoded["target_words"]
+    if len(preceding_context)+len(target_words)-1 > max_length:
+        return get_causal_target_logits(model,preceding_context,target_words,max_length,stride)
+
+    cached_length, entry = lookup_prefix_cache(prefix_cache,preceding_context)
+    past_key_values, last_logits = None, None
+    if entry is not None and entry["length"]>cached_length:
+        # only the logits of the last token of a cached sequence are kept, so if the whole
+        # context is shared with a longer sequence, its last token is run again
+        cached_length = min(cached_length,len(preceding_context)-1)
+        if cached_length>0:
+            past_key_values = crop_past_key_values(entry["past_key_values"],cached_length)
+    elif entry is not None:
+        past_key_values, last_logits = copy.deepcopy(entry["past_key_values"]), entry["last_logits"]
+    if past_key_values is None:
+        prefix_cache["misses"] += 1
+        cached_length = 0
+    else:
+        prefix_cache["hits"] += 1
+
+    new_context = preceding_context[cached_length:]
+    if len(new_context)>0:
+        input = torch.LongTensor([new_context]).to(model.device)
+        output = run_forward(model,input,past_key_values=past_key_values,use_cache=True)
+        past_key_values, last_logits = output.past_key_values, output.logits[0, -1, :]
+        insert_prefix_cache(prefix_cache,preceding_context,copy.deepcopy(past_key_values),last_logits)
+
+    if len(target_words)==0:
+        return None
+    input = torch.LongTensor([target_words]).to(model.device)
+    output = run_forward(model,input,past_key_values=past_key_values,use_cache=True)
+    insert_prefix_cache(prefix_cache,preceding_context+target_words,output.past_key_values,output.logits[0, -1, :])
+    return torch.cat([last_logits.unsqueeze(0),output.logits[0, :-1, :]])
+
+def remove_boundary_tokens(target_words,tokenizer):
+    if tokenizer.bos_token_id  in target_words:
+        target_words.remove(tokenizer.bos_token_id)
+    if tokenizer.eos_token_id  in target_words:
+        target_words.remove(tokenizer.eos_token_id)
+    return target_words
+
+def encode_stimuli(stimulus_list,tokenizer,reversed_tokenizer):
+    # splits each stimulus into (preceding context, target words, following words) token ids,
+    # with all the stimuli encoded (and decoded) in batches; stimuli that cannot be split
+    # (e.g. without two markers) are None
+    stimuli = [stimulus_reader.clean_stimulus(stimulus) for stimulus in stimulus_list]
+    stimuli_spaces = [stimulus.replace(" *", "* ").replace("*", "[!StimulusMarker!]") for stimulus in stimuli]
+    encoded_stimuli = tokenizer(stimuli_spaces)["input_ids"] if stimuli_spaces else []
+
+    #stimulus_marker_idx = tokenizer.encode("[!StimulusMarker!]")
+    #if tokenizer.bos_token_id  in stimulus_marker_idx:
+        #stimulus_marker_idx.remove(tokenizer.bos_token_id)
+    #if tokenizer.eos_token_id  in stimulus_marker_idx:
+        #stimulus_marker_idx.remove(tokenizer.eos_token_id)
+    stimulus_marker_idx = tokenizer.additional_special_tokens_ids[tokenizer.additional_special_tokens.index("[!StimulusMarker!]")]
+
+    spans = [None]*len(stimuli)
+    for j in range(len(stimuli)):
+        encoded_stimulus = encoded_stimuli[j]
+        dummy_var_idxs = [idx for idx in range(len(encoded_stimulus)) if encoded_stimulus[idx]==stimulus_marker_idx]
+        if len(dummy_var_idxs)<2:
+            continue
+        preceding_context = encoded_stimulus[:dummy_var_idxs[0]]
+        if len(preceding_context)==0 or not ((preceding_context[0]==tokenizer.bos_token_id) or (preceding_context[0]==tokenizer.eos_token_id)):
+            preceding_context = [tokenizer.bos_token_id] + preceding_context
+        target_words = encoded_stimulus[dummy_var_idxs[0]+1:dummy_var_idxs[1]]
+        following_words = encoded_stimulus[dummy_var_idxs[1]+1:]
+        spans[j] = [preceding_context,target_words,following_words]
+
+    # targets preceded by a space are re-encoded with a leading space if they do not already
+    # decode to one, and a lone space token before a word-initial token is then dropped
+    spaced_lines = [j for j in range(len(stimuli)) if spans[j] is not None and "[!StimulusMarker!] " in stimuli_spaces[j]]
+    decoded_targets = tokenizer.batch_decode([spans[j][1] for j in spaced_lines]) if spaced_lines else []
+    reencode_lines = []
+    for k in range(len(spaced_lines)):
+        if len(decoded_targets[k])==0:
+            spans[spaced_lines[k]] = None
+        elif decoded_targets[k][0]!=" ":
+            reencode_lines.append((spaced_lines[k]," " + decoded_targets[k]))
+    if reencode_lines:
+        reencoded_targets = tokenizer([target_words_decoded for j, target_words_decoded in reencode_lines])["input_ids"]
+        for k in range(len(reencode_lines)):
+            spans[reencode_lines[k][0]][1] = remove_boundary_tokens(list(reencoded_targets[k]),tokenizer)
+
+    spaced_lines = [j for j in spaced_lines if spans[j] is not None]
+    decoded_targets = tokenizer.batch_decode([spans[j][1] for j in spaced_lines]) if spaced_lines else []
+    for k in range(len(spaced_lines)):
+        j = spaced_lines[k]
+        if len(decoded_targets[k])==0:
+            spans[j] = None
+            continue
+        target_words = spans[j][1]
+        if decoded_targets[k][0]==" " and len(target_words)>1:
+            if reversed_tokenizer[target_words[0]]=="▁" and reversed_tokenizer[target_words[1]][0]=="▁":
+                spans[j][1] = target_words[1:]
+            elif reversed_tokenizer[target_words[0]]==" " and reversed_tokenizer[target_words[1]][0]==" ":
+                spans[j][1] = target_words[1:]
+
+    return [{"stimulus":stimuli[j],"preceding_context":spans[j][0],"target_words":spans[j][1],"following_words":spans[j][2]}
+            if spans[j] is not None else None for j in range(len(stimuli))]
+
+def get_tokenizer_hash(tokenizer):
+    # identifies a tokenizer (including the added marker token) for the token cache, so that
+    # models that share a tokenizer share their cached encodings
+    tokenizer_hash = hashlib.sha1(type(tokenizer).__name__.encode("utf-8"))
+    if tokenizer.is_fast:
+        tokenizer_hash.update(tokenizer.backend_tokenizer.to_str().encode("utf-8"))
+    else:
+        tokenizer_hash.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode("utf-8"))
+    tokenizer_hash.update(json.dumps([tokenizer.bos_token_id,tokenizer.eos_token_id,tokenizer.additional_special_tokens_ids]).encode("utf-8"))
+    return tokenizer_hash.hexdigest()
+
+# encodings of the stimulus files already used in this process, keyed by tokenizer and stimuli
+encoded_stimuli_cache = dict()
+
+def get_encoded_stimuli(stimulus_list,tokenizer,reversed_tokenizer,tokenizer_hash,token_cache_directory,memory_cache=True):
+    # encoded stimuli are cached (in memory and in .npy files in token_cache_directory) as one
+    # flat array of token ids plus the lengths of the preceding context, target words and
+    # following words of each stimulus (-1 for stimuli that cannot be split); the cache is keyed
+    # by the stimuli passed in, so a stimulus file that is streamed is cached one block at a time
+    # (and only on disk), and a run with a different block size or shard encodes it again
+    stimuli_hash = hashlib.sha1("\n".join(stimulus_list).encode("utf-8")).hexdigest()
+    cache_key = (tokenizer_hash,stimuli_hash)
+    if cache_key in encoded_stimuli_cache:
+        return encoded_stimuli_cache[cache_key]
+
+    cache_filename = None
+    if token_cache_directory:
+        cache_filename = os.path.join(token_cache_directory,"{0}.{1}".format(tokenizer_hash,stimuli_hash))
+    try:
+        span_lengths = np.load(cache_filename+".spans.npy")
+        assert len(span_lengths)==len(stimulus_list)
+        # the stimuli are scored as lists of token ids, so the whole array is converted at once
+        token_ids = np.load(cache_filename+".tokens.npy").tolist()
+        offsets = np.concatenate([[0],np.cumsum(np.maximum(span_lengths,0).sum(axis=1))]).tolist()
+        encoded_stimuli = []
+        for j in range(len(stimulus_list)):
+            if span_lengths[j,0]<0:
+                encoded_stimuli.append(None)
+                continue
+            split_points = (offsets[j] + np.cumsum(span_lengths[j])).tolist()
+            encoded_stimuli.append({"stimulus":stimulus_reader.clean_stimulus(stimulus_list[j]),
+                                    "preceding_context":token_ids[offsets[j]:split_points[0]],
+                                    "target_words":token_ids[split_points[0]:split_points[1]],
+                                    "following_words":token_ids[split_points[1]:split_points[2]]})
+    except:
+        encoded_stimuli = encode_stimuli(stimulus_list,tokenizer,reversed_tokenizer)
+        if cache_filename:
+            try:
+                token_ids = []
+                span_lengths = []
+                for encoded in encoded_stimuli:
+                    if encoded is None:
+                        span_lengths.append([-1,-1,-1])
+                        continue
+                    token_ids += encoded["preceding_context"] + encoded["target_words"] + encoded["following_words"]
+                    span_lengths.append([len(encoded["preceding_context"]),len(encoded["target_words"]),len(encoded["following_words"])])
+                os.makedirs(token_cache_directory,exist_ok=True)
+                # written under temporary names first, as other processes may be reading the same cache
+                for suffix, array in [(".tokens.npy",np.array(token_ids,dtype=np.int64)),(".spans.npy",np.array(span_lengths,dtype=np.int64).reshape(-1,3))]:
+                    temporary_filename = "{0}.{1}.tmp.npy".format(cache_filename,os.getpid())
+                    np.save(temporary_filename,array)
+                    os.replace(temporary_filename,cache_filename+suffix)
+            except:
+                print("Cannot write token cache to {0}".format(token_cache_directory))
+
+    if memory_cache:
+        encoded_stimuli_cache[cache_key] = encoded_stimuli
+    return encoded_stimuli
+
+def get_metric_values(target_logits,target_words,metric_dict,arg_dict):
+    # all metrics are computed from the same log-softmax, and metrics that share a per-token
+    # function (e.g. surprisal and token_surprisal) share its result
+    metric_values = dict()
+    if len(target_words)>0:
+        with timed("metric"):
+            # in float32, so that bfloat16 logits keep the precision of the metrics
+            log_probability_distribution = F.log_softmax(target_logits.float(),dim=-1)
+            token_values = dict()
+            for metric in metric_dict:
+                metric_function = metric_definitions[metric]["function"]
+                if not metric_function in token_values:
+                    token_values[metric_function] = metric_function(log_probability_distribution,target_words,arg_dict).tolist()
+                metric_values[metric] = token_values[metric_function]
+    for metric in metric_dict:
+        if not metric in metric_values:
+            metric_values[metric] = []
+    return metric_values
+
+def aggregate_metric_values(metric,values):
+    aggregation = metric_definitions[metric]["aggregation"]
+    if aggregation=="sum":
+        return np.sum(values)
+    elif aggregation=="first":
+        return values[0] if len(values)>0 else np.nan
+    elif aggregation=="list":
+        return ",".join([str(value) for value in values])
+
+def score_stimuli(model,tokenizer,model_type,encoded_stimuli,line_idxs,metric_dict,arg_dict,scoring_state,document_ids=None):
+    # returns the metric values for each of the lines in line_idxs that could be scored;
+    # scoring_state holds anything kept between calls (recurrent state, prefix cache); with
+    # document_ids (the document of each line, as read by stimulus_reader), nothing is carried
+    # over from one document to the next, so that each document is scored the same way however
+    # the stimulus file is split into blocks or shards
+    stimulus_metric_values = dict()
+    valid_lines = [j for j in line_idxs if encoded_stimuli[j] is not None]
+    max_length = get_max_length(model,tokenizer)
+    stride = get_window_stride(max_length,arg_dict)
+    if model_type=="causal" and is_recurrent_model(model) and arg_dict["use_recurrent_state"]:
+        if not "recurrent_cache" in scoring_state:
+            scoring_state["recurrent_cache"] = dict()
+            reset_recurrent_cache(scoring_state["recurrent_cache"])
+        recurrent_cache = scoring_state["recurrent_cache"]
+        for k in range(len(valid_lines)):
+            j = valid_lines[k]
+            if document_ids is not None and (k==0 or document_ids[j]!=document_ids[valid_lines[k-1]]):
+                reset_recurrent_cache(recurrent_cache)
+            next_encoded = None
+            for next_j in range(j+1,len(encoded_stimuli)):
+                if document_ids is not None and document_ids[next_j]!=document_ids[j]:
+                    break
+                if encoded_stimuli[next_j] is not None:
+                    next_encoded = encoded_stimuli[next_j]
+                    break
+            try:
+                start_time = time.perf_counter()
+                target_logits = score_recurrent_stimulus(model,encoded_stimuli[j],next_encoded,recurrent_cache)
+                record_latencies(time.perf_counter()-start_time,1)
+                stimulus_metric_values[j] = get_metric_values(target_logits,encoded_stimuli[j]["target_words"],metric_dict,arg_dict)
+            except:
+                record_error("recurrent_stimulus")
+                reset_recurrent_cache(recurrent_cache)
+    elif model_type=="causal" and arg_dict["kv_cache_size"]>0 and not is_recurrent_model(model):
+        if not "prefix_cache" in scoring_state:
+            scoring_state["prefix_cache"] = create_prefix_cache(arg_dict["kv_cache_size"]*1024*1024)
+        for k in range(len(valid_lines)):
+            j = valid_lines[k]
+            if document_ids is not None and (k==0 or document_ids[j]!=document_ids[valid_lines[k-1]]):
+                clear_prefix_cache(scoring_state["prefix_cache"])
+            try:
+                start_time = time.perf_counter()
+                target_logits = score_cached_stimulus(model,encoded_stimuli[j],scoring_state["prefix_cache"],max_length,stride)
+                record_latencies(time.perf_counter()-start_time,1)
+                stimulus_metric_values[j] = get_metric_values(target_logits,encoded_stimuli[j]["target_words"],metric_dict,arg_dict)
+            except:
+                record_error("cached_stimulus")
+    elif model_type=="causal":
+        prefix_chains = get_prefix_chains(encoded_stimuli,valid_lines,document_ids)
+        for j, target_logits in score_causal_chains(model,encoded_stimuli,prefix_chains,max_length,stride,arg_dict["batch_size"],get_pad_token_id(tokenizer)):
+            try:
+                stimulus_metric_values[j] = get_metric_values(target_logits,encoded_stimuli[j]["target_words"],metric_dict,arg_dict)
+            except:
+                record_error("causal_metrics")
+    elif model_type=="masked" or model_type=="causal_mask":
+        model_input_lengths = [len(encoded_stimuli[j]["preceding_context"])+len(encoded_stimuli[j]["following_words"]) for j in valid_lines]
+        masked_inputs = {j:get_masked_inputs(encoded_stimuli[j],tokenizer,arg_dict["include_following_context"],max_length) for j in valid_lines}
+        input_counts = Counter([tuple(model_input_list) for j in valid_lines for model_input_list in masked_inputs[j]])
+        shared_logits = dict()
+        for bucket in get_length_buckets(model_input_lengths,arg_dict["batch_size"]):
+            batch_lines = [valid_lines[idx] for idx in bucket]
+            try:
+                start_time = time.perf_counter()
+                batch_target_logits = score_masked_batch(model,tokenizer,[masked_inputs[j] for j in batch_lines],input_counts,shared_logits)
+                record_latencies(time.perf_counter()-start_time,len(batch_lines))
+                for b in range(len(batch_lines)):
+                    j = batch_lines[b]
+                    stimulus_metric_values[j] = get_metric_values(batch_target_logits[b],encoded_stimuli[j]["target_words"],metric_dict,arg_dict)
+            except:
+                record_error("masked_batch")
+    return stimulus_metric_values
+
+def get_output_fields(encoded,tokenizer,model_type,max_length,arg_dict):
+    # the FullSentence, Sentence, TargetWords, NumTokens and ContextTokens fields of an output row
+    stimulus = encoded["stimulus"]
+    preceding_context = encoded["preceding_context"]
+    target_words = encoded["target_words"]
+    following_words = encoded["following_words"]
+
+    num_tokens = len(target_words)
+
+    sentence_idxs = preceding_context[1:]+target_words
+    if arg_dict["include_following_context"]==True:
+        sentence_idxs = sentence_idxs+following_words
+    if sentence_idxs[-1]==tokenizer.eos_token_id:
+        sentence_idxs = sentence_idxs[:-1]
+    sentence = tokenizer.decode(sentence_idxs)                        
+    target_string = tokenizer.decode(target_words)
+    return {"FullSentence":stimulus_reader.get_full_sentence(stimulus),
+            "Sentence":sentence.replace("\n","\\n").replace("\r","\\r").replace("\t","\\t").replace('"','\"').replace("'","\'"),
+            "TargetWords":target_string,
+            "NumTokens":num_tokens,
+            "ContextTokens":get_context_lengths(encoded,tokenizer,model_type,max_length,arg_dict)}
+
+def format_output_rows(output_fields,metric_values,metric_dict):
+    output_rows = dict()
+    for metric in metric_dict:
+        output_rows[metric] = "{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n".format(
+            output_fields["FullSentence"],
+            output_fields["Sentence"],
+            output_fields["TargetWords"],
+            aggregate_metric_values(metric,metric_values[metric]),
+            output_fields["NumTokens"],
+            ",".join([str(context_length) for context_length in output_fields["ContextTokens"]])
+        )
+    return output_rows
+
+def get_store_row(line_id,output_fields,metric_values,metric_dict):
+    store_row = dict(output_fields)
+    store_row["line_id"] = line_id
+    for metric in metric_dict:
+        if metric_definitions[metric]["aggregation"]!="list":
+            store_row[get_metric_name(metric)] = float(aggregate_metric_values(metric,metric_values[metric]))
+    for metric in ["surprisal","token_surprisal"]:
+        if metric in metric_dict:
+            store_row["TokenSurprisals"] = [float(value) for value in metric_values[metric]]
+    return store_row
+
+def get_manifest_filename(output_directory,stimuli_name,model_name_cleaned,model_type):
+    # manifests are kept in a hidden folder so that the output directory only has .output files
+    return os.path.join(output_directory,".manifests","{0}.{1}.{2}.json".format(stimuli_name,model_name_cleaned,model_type))
+
+def load_manifest(manifest_filename):
+    try:
+        with open(manifest_filename,"r") as f:
+            return json.load(f)
+    except:
+        return None
+
+def save_manifest(manifest_filename,manifest):
+    os.makedirs(os.path.dirname(manifest_filename),exist_ok=True)
+    with open(manifest_filename+".tmp","w") as f:
+        json.dump(manifest,f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(manifest_filename+".tmp",manifest_filename)
 
-                  
 def process_stims(model,tokenizer,model_type,model_name_cleaned,arg_dict):
-    reversed_tokenizer = inv_map = {v: k for k, v in tokenizer.get_vocab().items()}
+    reversed_tokenizer, tokenizer_hash = get_tokenizer_vocabulary(tokenizer)
+    scoring_state = dict()
+    max_length = get_max_length(model,tokenizer)
+    # in the results store, the revision is kept in its own column rather than in the model name
+    store_model, store_revision = (model_name_cleaned.split("___")+["[!latest!]"])[:2]
     for i in range(len(arg_dict["stimulus_file_list"])):
         stimuli_name = arg_dict["stimulus_file_list"][i].split('/')[-1].split('.')[0] 
         filenames = dict()
@@ -355,114 +1581,219 @@ def process_stims(model,tokenizer,model_type,model_name_cleaned,arg_dict):
         if arg_dict["standard_metric_list"]:
             for metric in arg_dict["standard_metric_list"]:
                 filenames[metric] = arg_dict["output_directory"] + "/" + stimuli_name + "." + metric + "." + model_name_cleaned + "." + model_type +".output"
-                with open(filenames[metric],"w") as f:
-                    f.write("FullSentence\tSentence\tTargetWords\t{}\tNumTokens\n".format(get_metric_name(metric)))
                 metric_dict[metric]= []
 
-        with open(arg_dict["stimulus_file_list"][i],'r') as f:
-            stimulus_list = f.read().splitlines() 
-        for j in range(len(stimulus_list)):
-            
-            for metric in metric_dict:
-                metric_dict[metric]=[]
+        # each shard of a stimulus file is written to its own files in the shards folder, to be
+        # put back together with merge_shards.py
+        shard_suffix = ""
+        if arg_dict["shard"]:
+            shard_suffix = ".{0}-of-{1}".format(*arg_dict["shard"])
+            os.makedirs(os.path.join(arg_dict["output_directory"],"shards"),exist_ok=True)
+            for metric in filenames:
+                filenames[metric] = os.path.join(arg_dict["output_directory"],"shards",os.path.basename(filenames[metric])+shard_suffix)
 
-            try:
-                stimulus = stimulus_list[j]
-                stimulus = stimulus.replace("\\n","\n").replace("\\r","\r").replace("\\t","\t").replace('\"','"').replace("\'","'")
-                stimulus_spaces = stimulus.replace(" *", "* ")
-                stimulus_spaces = stimulus_spaces.replace("*", "[!StimulusMarker!]")
-                encoded_stimulus = tokenizer.encode(stimulus_spaces)
-                
+        # a manifest records how many lines have been written (and the size of each output
+        # file at that point) for this stimulus file, model and revision, so that an
+        # interrupted run can be resumed; it is removed once the stimulus file is done
+        manifest_filename = get_manifest_filename(arg_dict["output_directory"],stimuli_name+shard_suffix,model_name_cleaned,model_type)
+        stimulus_hash = stimulus_reader.get_stimulus_file_hash(arg_dict["stimulus_file_list"][i])
+        manifest = load_manifest(manifest_filename) if arg_dict["resume"] else None
+        if manifest and manifest["stimulus_hash"]==stimulus_hash and sorted(manifest["offsets"])==sorted(filenames) and all([os.path.exists(filenames[metric]) for metric in filenames]):
+            start_line = manifest["last_line"]
+            for metric in filenames:
+                with open(filenames[metric],"r+") as f:
+                    f.truncate(manifest["offsets"][metric])
+            print("Resuming {0} with {1} from line {2}".format(stimuli_name,model_name_cleaned,start_line+1))
+        elif arg_dict["resume"] and filenames and all([os.path.exists(filenames[metric]) for metric in filenames]) and not os.path.exists(manifest_filename):
+            print("Skipping {0} with {1}: already complete".format(stimuli_name,model_name_cleaned))
+            continue
+        else:
+            start_line = 0
+            for metric in filenames:
+                with open(filenames[metric],"w") as f:
+                    f.write("FullSentence\tSentence\tTargetWords\t{}\tNumTokens\tContextTokens\n".format(get_metric_name(metric)))
+            manifest = {"stimuli":arg_dict["stimulus_file_list"][i],"model":model_name_cleaned,"model_type":model_type,
+                        "stimulus_hash":stimulus_hash,"last_line":0,
+                        "offsets":{metric:os.path.getsize(filenames[metric]) for metric in filenames}}
+            save_manifest(manifest_filename,manifest)
+            # the parts of the other shards of this run are left in place
+            if arg_dict["results_store"]:
+                results_store.clear_partition(arg_dict["results_store"],stimuli_name,store_model,store_revision,arg_dict["shard"])
 
-                #stimulus_marker_idx = tokenizer.encode("[!StimulusMarker!]")
-                #if tokenizer.bos_token_id  in stimulus_marker_idx:
-                    #stimulus_marker_idx.remove(tokenizer.bos_token_id)
-                #if tokenizer.eos_token_id  in stimulus_marker_idx:
-                    #stimulus_marker_idx.remove(tokenizer.eos_token_id)
-                stimulus_marker_idx = tokenizer.additional_special_tokens_ids[tokenizer.additional_special_tokens.index("[!StimulusMarker!]")]
+        if "prefix_cache" in scoring_state:
+            scoring_state["prefix_cache"]["hits"], scoring_state["prefix_cache"]["misses"] = 0, 0
 
+        output_files = dict()
+        try:
+            for metric in filenames:
+                output_files[metric] = open(filenames[metric],"a",buffering=1024*1024)
+
+            # the stimulus file is read, encoded and scored one block of whole documents at a time
+            for documents in stimulus_reader.read_stimulus_blocks(arg_dict["stimulus_file_list"][i],arg_dict["checkpoint_every"],arg_dict["shard"]):
+                block_end = documents[-1][-1][0]+1
+                if block_end<=start_line:
+                    continue
+                block_lines = [(d,line_idx,stimulus) for d in range(len(documents)) for line_idx, stimulus in documents[d] if line_idx>=start_line]
+                block = [(line_idx,stimulus) for d, line_idx, stimulus in block_lines]
+                document_ids = [d for d, line_idx, stimulus in block_lines]
+                stimulus_list = [stimulus for line_idx, stimulus in block]
+                with timed("encoding"):
+                    encoded_stimuli = get_encoded_stimuli(stimulus_list,tokenizer,reversed_tokenizer,tokenizer_hash,arg_dict["token_cache"],memory_cache=False)
+                line_idxs = range(len(block))
+                stimulus_metric_values = dict()
+                if metric_dict:
+                    stimulus_metric_values = score_stimuli(model,tokenizer,model_type,encoded_stimuli,line_idxs,metric_dict,arg_dict,scoring_state,document_ids)
+
+                store_rows = []
+                for j in line_idxs:
+                    try:
+                        with timed("decode"):
+                            output_fields = get_output_fields(encoded_stimuli[j],tokenizer,model_type,max_length,arg_dict)
+                        with timed("write"):
+                            output_rows = format_output_rows(output_fields,stimulus_metric_values[j],metric_dict)
+                            for metric in metric_dict:
+                                output_files[metric].write(output_rows[metric])
+                            store_rows.append(get_store_row(block[j][0]+1,output_fields,stimulus_metric_values[j],metric_dict))
+                        record_count("stimuli",1)
+                        record_count("target_tokens",output_fields["NumTokens"])
+                    except:
+                        record_count("failed_stimuli",1)
+                        print("Problem with stimulus on line {0}: {1}\n".format(str(block[j][0]+1),stimulus_list[j]))
+
+                with timed("write"):
+                    if arg_dict["results_store"]:
+                        results_store.write_results_part(arg_dict["results_store"],stimuli_name,store_model,store_revision,block[0][0],store_rows,
+                                                         [get_metric_name(metric) for metric in metric_dict if metric_definitions[metric]["aggregation"]!="list"],
+                                                         shard=arg_dict["shard"])
+
+                    for metric in output_files:
+                        output_files[metric].flush()
+                        os.fsync(output_files[metric].fileno())
+                    manifest["last_line"] = block_end
+                    manifest["offsets"] = {metric:output_files[metric].tell() for metric in output_files}
+                    save_manifest(manifest_filename,manifest)
+        finally:
+            for metric in output_files:
+                output_files[metric].close()
+
+        if os.path.exists(manifest_filename):
+            os.remove(manifest_filename)
+
+        if "prefix_cache" in scoring_state:
+            print("{0}: prefix cache hits {1}, misses {2}".format(stimuli_name,scoring_state["prefix_cache"]["hits"],scoring_state["prefix_cache"]["misses"]))
+
+        write_trace_record({"event":"stimuli","model":model_name_cleaned,"model_type":model_type,"stimuli":stimuli_name})
                 
-                dummy_var_idxs = np.where(np.array(encoded_stimulus)==stimulus_marker_idx)[0]
-                preceding_context = encoded_stimulus[:dummy_var_idxs[0]]
-                if len(preceding_context)==0 or not ((preceding_context[0]==tokenizer.bos_token_id) or (preceding_context[0]==tokenizer.eos_token_id)):
-                    preceding_context = [tokenizer.bos_token_id] + preceding_context
-                target_words = encoded_stimulus[dummy_var_idxs[0]+1:dummy_var_idxs[1]]
-                following_words = encoded_stimulus[dummy_var_idxs[1]+1:]
-
-                if "[!StimulusMarker!] " in stimulus_spaces and tokenizer.decode(target_words)[0]!=" ":
-                    target_words_decoded = " " + tokenizer.decode(target_words)
-                    target_words = tokenizer.encode(target_words_decoded)
-                    if tokenizer.bos_token_id  in target_words:
-                        target_words.remove(tokenizer.bos_token_id)
-                    if tokenizer.eos_token_id  in target_words:
-                        target_words.remove(tokenizer.eos_token_id)
-                
-                if "[!StimulusMarker!] " in stimulus_spaces and tokenizer.decode(target_words)[0]==" ": 
-                    if len(target_words)>1:
-                        if reversed_tokenizer[target_words[0]]=="▁" and reversed_tokenizer[target_words[1]][0]=="▁":
-                            target_words=target_words[1:]
-                        elif reversed_tokenizer[target_words[0]]==" " and reversed_tokenizer[target_words[1]][0]==" ":
-                            target_words=target_words[1:]
-                                            
-                current_context = copy.deepcopy(preceding_context)
-              
-
-                if ("standard_metric_list" in arg_dict) or ("lp_norms" in arg_dict) or ("renyi" in arg_dict):
-                    for k in range(len(target_words)):
-                        current_target = target_words[k]
-                        if model_type=="causal":
-                            input = torch.LongTensor([current_context[-tokenizer.model_max_length:]]).to(model.device)
-                            with torch.no_grad():
-                                next_token_logits = model(input, return_dict=True).logits[:, -1, :]
-                        elif model_type=="masked" or model_type=="causal_mask":
-                            context_plus_mask = current_context + [tokenizer.mask_token_id]
-                            if arg_dict["include_following_context"]==True:
-                                context_plus_mask = context_plus_mask + following_words
-                            model_input_list = context_plus_mask+[tokenizer.eos_token_id]
-                            mask_idx = model_input_list.index(tokenizer.mask_token_id)
-                            input = torch.LongTensor([model_input_list]).to(model.device)
-                            with torch.no_grad():
-                                next_token_logits = model(input, return_dict=True).logits[:, mask_idx, :]
-                        probability_distribution = F.softmax(next_token_logits,dim=-1)
-                        true_dist = torch.zeros(probability_distribution.shape).to(model.device)
-                        true_dist[0,current_target]=1                       
-                        
-                        if "surprisal" in metric_dict:
-                            surprisal = -torch.log(probability_distribution[0,current_target]).item()
-                            metric_dict["surprisal"].append(surprisal)
-
-                        current_context.append(current_target)
-
-                num_tokens = len(target_words)
-
-                sum_metric_dict = dict()
-                for metric in metric_dict:
-                    sum_metric_dict[metric] = np.sum(metric_dict[metric])
-                sentence_idxs = preceding_context[1:]+target_words
-                if arg_dict["include_following_context"]==True:
-                    sentence_idxs = sentence_idxs+following_words
-                if sentence_idxs[-1]==tokenizer.eos_token_id:
-                    sentence_idxs = sentence_idxs[:-1]
-                sentence = tokenizer.decode(sentence_idxs)                        
-                target_string = tokenizer.decode(target_words)
-                for metric in metric_dict:
-                    with open(filenames[metric],"a") as f:
-                        f.write("{0}\t{1}\t{2}\t{3}\t{4}\n".format(
-                            stimulus.replace("*","").replace("\n","\\n").replace("\r","\\r").replace("\t","\\t").replace('"','\"').replace("'","\'"),
-                            sentence.replace("\n","\\n").replace("\r","\\r").replace("\t","\\t").replace('"','\"').replace("'","\'"),
-                            target_string,
-                            sum_metric_dict[metric],
-                            num_tokens
-                        ))
-            except:
-                print("Problem with stimulus on line {0}: {1}\n".format(str(j+1),stimulus_list[j]))
-                
+
+def read_wikitext_documents(filename):
+    # splits the raw WikiText test set into its articles, each starting at a top-level heading
+    # (' = Title = '), as in the document-level WikiText that lm_eval evaluates on
+    documents = []
+    document_lines = []
+    with open(filename,'r',encoding="utf-8") as f:
+        lines = f.read().split("\n")
+    for line in lines:
+        heading = line.replace("= = =","===").replace("= =","==").strip()
+        if heading.startswith("= ") and heading.endswith(" ="):
+            if "\n".join(document_lines).strip():
+                documents.append("\n".join(document_lines))
+            document_lines = []
+        document_lines.append(line)
+    if "\n".join(document_lines).strip():
+        documents.append("\n".join(document_lines))
+    return documents
+
+def detokenize_wikitext(text):
+    # undoes the tokenization of WikiText in the same way as lm_eval
+    text = text.replace("s '","s'")
+    text = re.sub(r"/' [0-9]/",r"/'[0-9]/",text)
+    text = text.replace(" @-@ ","-").replace(" @,@ ",",").replace(" @.@ ",".")
+    text = text.replace(" : ",": ").replace(" ; ","; ").replace(" . ",". ").replace(" ! ","! ").replace(" ? ","? ").replace(" , ",", ")
+    text = re.sub(r"\(\s*([^\)]*?)\s*\)",r"(\1)",text)
+    text = re.sub(r"\[\s*([^\]]*?)\s*\]",r"[\1]",text)
+    text = re.sub(r"{\s*([^}]*?)\s*}",r"{\1}",text)
+    text = re.sub(r"\"\s*([^\"]*?)\s*\"",r'"\1"',text)
+    text = re.sub(r"'\s*([^']*?)\s*'",r"'\1'",text)
+    text = text.replace("= = = =","====").replace("= = =","===").replace("= =","==")
+    text = text.replace(" "+chr(176)+" ",chr(176))
+    text = text.replace(" \n","\n").replace("\n ","\n")
+    text = text.replace(" N "," 1 ").replace(" 's","'s")
+    return text
+
+def get_rolling_windows(token_ids,start_token,max_length):
+    # the rolling windows of lm_eval's loglikelihood_rolling: the tokens are predicted in
+    # consecutive, non-overlapping groups of max_length, the first from the start token and each
+    # of the others from the tokens before it, so that every window is max_length tokens long
+    windows = [{"preceding_context":[start_token],"target_words":token_ids[:max_length],"following_words":[]}]
+    predicted = min(max_length,len(token_ids))
+    while predicted<len(token_ids):
+        window_end = min(predicted+max_length,len(token_ids))
+        windows.append({"preceding_context":token_ids[window_end-max_length-1:predicted],
+                        "target_words":token_ids[predicted:window_end],"following_words":[]})
+        predicted = window_end
+    return windows
+
+def calculate_perplexity(model,tokenizer,model_type,arg_dict):
+    # word-level perplexity (exp of the total surprisal over the number of words) on WikiText,
+    # computed as in lm_eval: each article is scored over rolling windows of the model's context
+    # length (2048 for models without one, as lm_eval's default), which are scored by
+    # score_stimuli like any other stimuli, and the detokenized text is scored but the words
+    # are counted in the original
+    if model_type!="causal":
+        print("Cannot calculate the perplexity of a {0} model".format(model_type))
+        return None
+    max_length = get_max_length(model,tokenizer)
+    if max_length==float("inf"):
+        max_length = 2048
+    start_token = tokenizer.bos_token_id if tokenizer.bos_token_id is not None else tokenizer.eos_token_id
+    encoded_chunks = []
+    num_words = 0
+    with timed("encoding"):
+        for document in read_wikitext_documents(arg_dict["perplexity_data"]):
+            num_words += len(re.split(r"\s+",document))
+            text = detokenize_wikitext(document)
+            token_ids = tokenizer(text,add_special_tokens=False)["input_ids"]
+            if token_ids:
+                encoded_chunks += get_rolling_windows(token_ids,start_token,max_length)
+    metric_values = score_stimuli(model,tokenizer,model_type,encoded_chunks,range(len(encoded_chunks)),{"surprisal":[]},arg_dict,dict())
+    if len(metric_values)<len(encoded_chunks):
+        print("Cannot calculate the perplexity: {0} of {1} chunks could not be scored".format(len(encoded_chunks)-len(metric_values),len(encoded_chunks)))
+        return None
+    return float(np.exp(np.sum([np.sum(metric_values[j]["surprisal"]) for j in metric_values])/num_words))
+
+def get_perplexity_model_name(model_name,revision,precision):
+    # as in the model names of perplexities.tsv, i.e. without the organisation
+    perplexity_model_name = model_name.rstrip("/").split("/")[-1].replace(".","_")
+    if revision!='[!latest!]':
+        perplexity_model_name = "{0}___{1}".format(perplexity_model_name,str(revision))
+    return get_precision_model_name(perplexity_model_name,precision)
+
+def save_perplexities(perplexity_filename,perplexity_rows):
+    # the perplexity of each model replaces any earlier one, and the rows of other models are kept
+    perplexities = OrderedDict()
+    if os.path.exists(perplexity_filename):
+        with open(perplexity_filename,"r") as f:
+            for line in f.read().splitlines()[1:]:
+                fields = line.split("\t")
+                perplexities[fields[0]] = fields[1]
+    for perplexity_row in perplexity_rows:
+        perplexities[perplexity_row["ModelName"]] = str(perplexity_row["Perplexity"])
+    if os.path.dirname(perplexity_filename):
+        os.makedirs(os.path.dirname(perplexity_filename),exist_ok=True)
+    with open(perplexity_filename+".tmp","w") as f:
+        f.write("ModelName\tPerplexity\n")
+        for perplexity_model_name in perplexities:
+            f.write("{0}\t{1}\n".format(perplexity_model_name,perplexities[perplexity_model_name]))
+    os.replace(perplexity_filename+".tmp",perplexity_filename)
 
 def main():
     args = parse_args()
     arg_dict = process_args(args)
     if arg_dict:
-        create_and_run_models(arg_dict)
+        if arg_dict["num_workers"]>1:
+            run_scheduled_jobs(arg_dict)
+        else:
+            create_and_run_models(arg_dict)
 
 if __name__ == "__main__":
     main()
@@ -1,3 +1,10 @@
 #!/bin/bash
 
-python calculate_surprisal.py -ii dataset_list.txt   -o ../results -t surprisal -mm model_list.txt
+# with a local copy of the WikiText test set (wikitext-2-raw-v1), the perplexity of each model is
+# also calculated while it is loaded, and written to ../statistics/calculated_perplexities.tsv
+# (the lm_eval perplexities in ../statistics/perplexities.tsv are left as they are)
+if [ -f ../wikitext/wiki.test.raw ]; then
+    python calculate_surprisal.py -ii dataset_list.txt   -o ../results -t surprisal -mm model_list.txt -pd ../wikitext/wiki.test.raw
+else
+    python calculate_surprisal.py -ii dataset_list.txt   -o ../results -t surprisal -mm model_list.txt
+fi
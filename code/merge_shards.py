@@ -0,0 +1,107 @@
+import os
+import re
+import argparse
+from collections import defaultdict
+import stimulus_reader
+
+# Combines the output files written by 'calculate_surprisal.py --shard i/N' into the output
+# file that a run over the whole stimulus file would have written. Shards are made of whole
+# documents (every N-th document goes to the same shard), so the rows of each document are
+# taken from its shard in the order of the stimulus file.
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Merges the shards of surprisal output files')
+
+    parser.add_argument('--stimuli', '-i', type=str,
+                        help='stimuli that were tested')
+    parser.add_argument('--stimuli_list', '-ii', type=str,
+                        help='path to file containing list of stimulus files that were tested')
+    parser.add_argument('--output_directory','-o', type=str, required = True,
+                        help='output directory that was used (the shards are in its shards folder)')
+    parser.add_argument('--keep_shards', '-k', action="store_true", default=False,
+                        help='keep the shard files after merging them')
+
+    args = parser.parse_args()
+    return args
+
+def get_shard_groups(shard_directory,stimuli_name):
+    # shard files are named <output file>.<i>-of-<N>; returns the shard files of each output
+    # file, keyed by the output file name and the number of shards
+    shard_groups = defaultdict(dict)
+    for shard_file_name in sorted(os.listdir(shard_directory)):
+        shard_match = re.match(r"^(.+\.output)\.(\d+)-of-(\d+)$",shard_file_name)
+        if shard_match and shard_match.group(1).split(".")[0]==stimuli_name:
+            output_file_name, shard_index, num_shards = shard_match.group(1), int(shard_match.group(2)), int(shard_match.group(3))
+            shard_groups[(output_file_name,num_shards)][shard_index] = os.path.join(shard_directory,shard_file_name)
+    return shard_groups
+
+def merge_shard_files(stimulus_file,shard_filenames,num_shards,output_filename):
+    shard_files = [open(shard_filenames[shard_index+1],"r") for shard_index in range(num_shards)]
+    try:
+        headers = [shard_file.readline() for shard_file in shard_files]
+        assert len(set(headers))==1
+        next_rows = [shard_file.readline() for shard_file in shard_files]
+        with open(output_filename+".tmp","w") as f:
+            f.write(headers[0])
+            for document_idx, document in enumerate(stimulus_reader.read_stimulus_documents(stimulus_file)):
+                shard_index = document_idx%num_shards
+                for line_idx, stimulus in document:
+                    # stimuli that could not be scored have no row in the shard
+                    full_sentence = stimulus_reader.get_full_sentence(stimulus_reader.clean_stimulus(stimulus))
+                    if next_rows[shard_index] and next_rows[shard_index].split("\t")[0]==full_sentence:
+                        f.write(next_rows[shard_index])
+                        next_rows[shard_index] = shard_files[shard_index].readline()
+            # every row of every shard must have been used
+            assert not any(next_rows)
+        os.replace(output_filename+".tmp",output_filename)
+    finally:
+        for shard_file in shard_files:
+            shard_file.close()
+        if os.path.exists(output_filename+".tmp"):
+            os.remove(output_filename+".tmp")
+
+def main():
+    args = parse_args()
+
+    if args.stimuli_list:
+        with open(args.stimuli_list,"r") as f:
+            stimulus_file_list = f.read().splitlines()
+    elif args.stimuli:
+        stimulus_file_list = [args.stimuli]
+    else:
+        print("Error: No stimuli specified.")
+        return
+
+    shard_directory = os.path.join(args.output_directory,"shards")
+    if not os.path.exists(shard_directory):
+        print("Error: No shards found in {0}".format(args.output_directory))
+        return
+
+    for stimulus_file in stimulus_file_list:
+        stimuli_name = stimulus_file.split('/')[-1].split('.')[0]
+        for (output_file_name, num_shards), shard_filenames in sorted(get_shard_groups(shard_directory,stimuli_name).items()):
+            missing_shards = [str(shard_index) for shard_index in range(1,num_shards+1) if not shard_index in shard_filenames]
+            if missing_shards:
+                print("Cannot merge {0}: missing shards {1} of {2}".format(output_file_name,",".join(missing_shards),num_shards))
+                continue
+            # a shard that is still running (or was interrupted) has a manifest
+            # (output files are named <stimuli>.<metric>.<model>.<model type>.output, and model
+            # names may contain dots)
+            model_and_type = output_file_name[:-len(".output")].split(".",2)[2]
+            manifest_names = ["{0}.{1}-of-{2}.{3}.json".format(stimuli_name,shard_index,num_shards,model_and_type)
+                              for shard_index in range(1,num_shards+1)]
+            if any([os.path.exists(os.path.join(args.output_directory,".manifests",manifest_name)) for manifest_name in manifest_names]):
+                print("Cannot merge {0}: not all shards are complete".format(output_file_name))
+                continue
+            try:
+                merge_shard_files(stimulus_file,shard_filenames,num_shards,os.path.join(args.output_directory,output_file_name))
+            except:
+                print("Cannot merge {0}: the shards do not match {1}".format(output_file_name,stimulus_file))
+                continue
+            if not args.keep_shards:
+                for shard_filename in shard_filenames.values():
+                    os.remove(shard_filename)
+            print("Merged {0} shards into {1}".format(num_shards,output_file_name))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import os
+import argparse
+import csv
+import pandas as pd
+
+# A partitioned Parquet store for surprisal results, as an alternative to one tsv file per
+# dataset x model. Files are laid out as <store>/dataset=<dataset>/model=<model>/<part>.parquet,
+# so that reads for one dataset or model only touch the files of that partition.
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Converts surprisal output files into a partitioned \
+                                    Parquet results store')
+
+    parser.add_argument('--results_directory', '-r', type=str, default='../results',
+                        help='directory of .output files to convert (default is ../results)')
+    parser.add_argument('--store', '-s', type=str, default='../results_store',
+                        help='path of the results store (default is ../results_store)')
+
+    args = parser.parse_args()
+    return args
+
+def get_partition_directory(store,dataset,model):
+    return os.path.join(store,"dataset={0}".format(dataset),"model={0}".format(model))
+
+def get_results_schema(metric_columns,extra_columns=[]):
+    import pyarrow as pa
+    fields = [pa.field("revision",pa.string()),
+              pa.field("line_id",pa.int32()),
+              pa.field("FullSentence",pa.string()),
+              pa.field("Sentence",pa.string()),
+              pa.field("TargetWords",pa.string())]
+    for column in metric_columns:
+        fields.append(pa.field(column,pa.float64()))
+    fields.append(pa.field("TokenSurprisals",pa.list_(pa.float64())))
+    fields.append(pa.field("NumTokens",pa.int32()))
+    fields.append(pa.field("ContextTokens",pa.list_(pa.int32())))
+    # extra columns (e.g. the item ids kept in shrunk results files) are given as (name, type)
+    for column, column_type in extra_columns:
+        fields.append(pa.field(column,pa.int64() if column_type=="int" else pa.string()))
+    return pa.schema(fields)
+
+def get_part_prefix(revision,shard=None):
+    # parts written by a sharded run are named by shard, so that the shards of one run do not
+    # overwrite each other and the parts of runs with a different shard count can be told apart
+    if shard:
+        return "{0}-shard{1}of{2}-".format(revision,*shard)
+    return revision+"-"
+
+def clear_partition(store,dataset,model,revision,shard=None):
+    # removes the parts previously written for this dataset, model and revision; for a shard,
+    # only the parts of the other shards of the same shard count are kept
+    partition_directory = get_partition_directory(store,dataset,model)
+    if os.path.exists(partition_directory):
+        for part_name in os.listdir(partition_directory):
+            if not part_name.startswith(revision+"-"):
+                continue
+            part_shard = part_name[len(revision)+1:].split("-")[0]
+            if shard and part_shard.startswith("shard") and part_shard.endswith("of{0}".format(shard[1])) \
+                    and not part_name.startswith(get_part_prefix(revision,shard)):
+                continue
+            try:
+                os.remove(os.path.join(partition_directory,part_name))
+            except FileNotFoundError:
+                # another shard may have removed it already
+                pass
+
+def write_results_part(store,dataset,model,revision,part_start,rows,metric_columns,extra_columns=[],shard=None):
+    # rows are dicts with the columns of get_results_schema; each part is written to a
+    # temporary file first so that a part is either complete or absent
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    partition_directory = get_partition_directory(store,dataset,model)
+    os.makedirs(partition_directory,exist_ok=True)
+    for row in rows:
+        row["revision"] = revision
+    table = pa.Table.from_pylist(rows,schema=get_results_schema(metric_columns,extra_columns))
+    part_filename = os.path.join(partition_directory,"{0}{1:09d}.parquet".format(get_part_prefix(revision,shard),part_start))
+    pq.write_table(table,part_filename+".tmp")
+    os.replace(part_filename+".tmp",part_filename)
+
+def load_results(store,dataset=None,model=None,revision=None,columns=None):
+    # reads the results for one dataset and/or model (or everything) into a DataFrame; the
+    # dataset and model filters are applied to the partition paths, so other partitions are
+    # never opened
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    results_dataset = ds.dataset(store,format="parquet",partitioning="hive",exclude_invalid_files=True)
+    expression = None
+    for field_name, value in [("dataset",dataset),("model",model),("revision",revision)]:
+        if value is not None:
+            condition = ds.field(field_name)==value
+            expression = condition if expression is None else expression & condition
+    fragments = list(results_dataset.get_fragments(filter=expression))
+    if not fragments:
+        return pd.DataFrame()
+    # files from different datasets may have different columns (e.g. after shrinking)
+    schema = pa.unify_schemas([fragment.physical_schema for fragment in fragments]+[results_dataset.partitioning.schema])
+    results_dataset = ds.dataset([fragment.path for fragment in fragments],schema=schema,format="parquet",
+                                 partitioning=ds.partitioning(results_dataset.partitioning.schema,flavor="hive"),
+                                 partition_base_dir=store)
+    results = results_dataset.to_table(filter=expression,columns=columns).to_pandas()
+    sort_columns = [column for column in ["dataset","model","revision","line_id"] if column in results.columns]
+    return results.sort_values(sort_columns).reset_index(drop=True)
+
+def convert_results_file(results_filename,store):
+    # results files are named <dataset>.<metric>.<model>.<model type>.output, with the
+    # revision (if any) appended to the model name after '___'
+    dataset, metric, model_name_cleaned = os.path.basename(results_filename).split(".")[:3]
+    model, revision = (model_name_cleaned.split("___")+["[!latest!]"])[:2]
+    content = pd.read_csv(results_filename,sep="\t",doublequote=False,escapechar=None,quoting=csv.QUOTE_NONE,keep_default_na=False)
+    standard_columns = ["FullSentence","Sentence","TargetWords","NumTokens","ContextTokens"]
+    metric_columns = [column for column in content.columns if not column in standard_columns and pd.api.types.is_float_dtype(content[column])]
+    extra_columns = [(column,"int" if pd.api.types.is_integer_dtype(content[column]) else "string") for column in content.columns
+                     if not column in standard_columns+metric_columns]
+    rows = []
+    for line_id, row in enumerate(content.to_dict("records")):
+        output_row = {"line_id":line_id+1,"NumTokens":int(row["NumTokens"])}
+        # files written before the ContextTokens column was added do not have it
+        if "ContextTokens" in row:
+            output_row["ContextTokens"] = [int(context_length) for context_length in str(row["ContextTokens"]).split(",") if context_length!=""]
+        for column in ["FullSentence","Sentence","TargetWords"]:
+            output_row[column] = str(row[column]) if column in row else None
+        for column, column_type in extra_columns:
+            output_row[column] = int(row[column]) if column_type=="int" else str(row[column])
+        for column in metric_columns:
+            output_row[column] = float(row[column])
+        rows.append(output_row)
+    clear_partition(store,dataset,model,revision)
+    write_results_part(store,dataset,model,revision,0,rows,metric_columns,extra_columns)
+
+def main():
+    args = parse_args()
+    for results_file_name in sorted(os.listdir(args.results_directory)):
+        if results_file_name.endswith(".output"):
+            try:
+                convert_results_file(os.path.join(args.results_directory,results_file_name),args.store)
+            except:
+                print("Cannot convert results file {0}".format(results_file_name))
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,177 @@
 import pandas as pd
 import os
 import csv
+import json
+import hashlib
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-stim_dir = "../cleaned_stimuli/"
-results_dir = "../results/"
+# Replaces the text columns of the results files of datasets with a stimulus table by the item
+# ids of that table. Each stimulus table is turned once into an index from a hash of its
+# FullSentence to the item ids, kept in the .shrink_index folder of the results directory, and
+# the results files are joined against that index in parallel. A fingerprint of each file is
+# recorded after it is processed, so that re-running only touches new or changed files.
 
+stimulus_tables = {
+    "futrell_2018":{"file":"futrell_2018_dl.tsv","sentence_column":"FullSentence","id_columns":["docid","sentid","sentpos"],"quoting":csv.QUOTE_MINIMAL},
+    "smith_2013":{"file":"smith_2013.tsv","sentence_column":"FullDocument","id_columns":["docid","sentid","sentpos"],"quoting":csv.QUOTE_MINIMAL},
+    "luke_2018":{"file":"luke_2018.tsv","sentence_column":"FullSentence_DocLevel","id_columns":["Word_Unique_ID"],"quoting":csv.QUOTE_NONE},
+    "kennedy_2003":{"file":"kennedy_2003.tsv","sentence_column":"FullSentence","id_columns":["docid","sentid","sentpos"],"quoting":csv.QUOTE_MINIMAL},
+}
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='Shrinks surprisal output files by replacing their \
+                                    text columns with the item ids of the stimulus tables')
 
-futrell_stims = pd.read_csv("../cleaned_stimuli/futrell_2018_dl.tsv",sep="\t")
+    parser.add_argument('--results_directory', '-r', type=str, default='../results',
+                        help='directory of .output files to shrink (default is ../results)')
+    parser.add_argument('--stimuli_directory', '-s', type=str, default='../cleaned_stimuli',
+                        help='directory of the stimulus tables (default is ../cleaned_stimuli)')
+    parser.add_argument('--num_workers', '-w', type=int, default=os.cpu_count(),
+                        help='number of results files to process in parallel (default is the number of CPUs)')
 
-luke_stims = pd.read_csv("../cleaned_stimuli/luke_2018.tsv",sep="\t",doublequote=False,escapechar=None,quoting=csv.QUOTE_NONE)
-luke_stims = luke_stims[["Word_Unique_ID","FullSentence_DocLevel"]].rename({"FullSentence_DocLevel":"FullSentence"},axis=1)
+    args = parser.parse_args()
+    return args
 
-kennedy_stims = pd.read_csv("../cleaned_stimuli/kennedy_2003.tsv",sep="\t")
+def get_sentence_key(sentence):
+    return hashlib.sha1(str(sentence).encode("utf-8")).hexdigest()
 
-smith_stims = pd.read_csv("../cleaned_stimuli/smith_2013.tsv",sep="\t")
-smith_stims = smith_stims[["docid","sentid","sentpos","FullDocument"]].rename({"FullDocument":"FullSentence"},axis=1)
+def get_file_fingerprint(filename):
+    file_hash = hashlib.sha1()
+    with open(filename,"rb") as f:
+        for chunk in iter(lambda:f.read(1024*1024),b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
 
+def get_dataset(results_file_name):
+    for dataset in stimulus_tables:
+        if dataset in results_file_name:
+            return dataset
+    return None
 
+def is_shrunk(results_filename):
+    # shrunk files no longer have a FullSentence column
+    with open(results_filename,"r") as f:
+        return not "FullSentence" in f.readline().rstrip("\n").split("\t")
 
+def read_table(filename,quoting):
+    return pd.read_csv(filename,sep="\t",doublequote=False if quoting==csv.QUOTE_NONE else True,escapechar=None,quoting=quoting)
 
+def get_index_filename(index_directory,dataset,table_fingerprint):
+    return os.path.join(index_directory,"{0}.{1}.tsv".format(dataset,table_fingerprint))
 
-for results_file_name in os.listdir(results_dir):
-    content = pd.read_csv(results_dir+results_file_name,sep="\t")
-    if "futrell_2018" in results_file_name:
-        content = content.merge(futrell_stims,how="inner",on="FullSentence")
-        content = content[["docid","sentid","sentpos","Surprisal","NumTokens"]].dropna()
-    elif "smith_2013" in results_file_name:
-        content = content.merge(smith_stims,how="inner",on="FullSentence")
-        content = content[["docid","sentid","sentpos","Surprisal","NumTokens"]].dropna()
-    elif "luke_2018" in results_file_name:
-        content = content.merge(luke_stims,how="inner",on="FullSentence")
-        content = content[["Word_Unique_ID","Surprisal","NumTokens"]].dropna()
-    elif "kennedy_2003" in results_file_name:
-        content = content.merge(kennedy_stims,how="inner",on="FullSentence")
-        content = content[["docid","sentid","sentpos","Surprisal","NumTokens"]].dropna()
-    content.to_csv(results_dir+results_file_name,sep="\t",doublequote=False,escapechar=None,quoting=csv.QUOTE_NONE,index=False)
\ No newline at end of file
+def build_index(stimuli_directory,index_directory,dataset):
+    # the index has the item ids of each row of the stimulus table and the key of its sentence,
+    # and is only rebuilt when the stimulus table changes
+    table = stimulus_tables[dataset]
+    table_filename = os.path.join(stimuli_directory,table["file"])
+    index_filename = get_index_filename(index_directory,dataset,get_file_fingerprint(table_filename))
+    if not os.path.exists(index_filename):
+        for old_index_name in os.listdir(index_directory):
+            if old_index_name.startswith(dataset+".") and old_index_name.endswith(".tsv"):
+                os.remove(os.path.join(index_directory,old_index_name))
+        stims = read_table(table_filename,table["quoting"])
+        stims["Key"] = [get_sentence_key(sentence) for sentence in stims[table["sentence_column"]]]
+        stims = stims[["Key"]+table["id_columns"]]
+        stims.to_csv(index_filename+".tmp",sep="\t",index=False)
+        os.replace(index_filename+".tmp",index_filename)
+    return index_filename
+
+# indexes already read by this process
+loaded_indexes = dict()
+
+def load_index(index_filename):
+    if not index_filename in loaded_indexes:
+        loaded_indexes[index_filename] = pd.read_csv(index_filename,sep="\t")
+    return loaded_indexes[index_filename]
+
+def shrink_results_file(results_filename,dataset,index_filename):
+    # the results are read with the same quoting as the stimulus table they are joined to, so
+    # that a sentence with quotation marks is parsed the same way on both sides
+    content = read_table(results_filename,stimulus_tables[dataset]["quoting"])
+    content["Key"] = [get_sentence_key(sentence) for sentence in content["FullSentence"]]
+    index = load_index(index_filename)
+    # rows whose sentence is not in the stimulus table (or that have no surprisal) are dropped
+    num_rows = len(content)
+    num_dropped = num_rows-int((content["Key"].isin(index["Key"]) & content[["Surprisal","NumTokens"]].notna().all(axis=1)).sum())
+    content = content.merge(index,how="inner",on="Key")
+    content = content[stimulus_tables[dataset]["id_columns"]+["Surprisal","NumTokens"]].dropna()
+    # written to a temporary file first, so that an interrupted run leaves the file as it was
+    content.to_csv(results_filename+".tmp",sep="\t",doublequote=False,escapechar=None,quoting=csv.QUOTE_NONE,index=False)
+    os.replace(results_filename+".tmp",results_filename)
+    return get_file_fingerprint(results_filename), num_rows, num_dropped
+
+def load_fingerprints(fingerprint_filename):
+    try:
+        with open(fingerprint_filename,"r") as f:
+            return json.load(f)
+    except:
+        return dict()
+
+def save_fingerprints(fingerprint_filename,fingerprints):
+    with open(fingerprint_filename+".tmp","w") as f:
+        json.dump(fingerprints,f,indent=1,sort_keys=True)
+    os.replace(fingerprint_filename+".tmp",fingerprint_filename)
+
+def is_unchanged(results_filename,fingerprint):
+    # the size and modification time are checked before the content, which is only hashed when
+    # they differ from those recorded
+    if not fingerprint:
+        return False
+    file_stat = os.stat(results_filename)
+    if [file_stat.st_size,file_stat.st_mtime_ns]==[fingerprint["size"],fingerprint["mtime_ns"]]:
+        return True
+    return get_file_fingerprint(results_filename)==fingerprint["sha1"]
+
+def record_fingerprint(fingerprints,results_filename,file_fingerprint):
+    file_stat = os.stat(results_filename)
+    fingerprints[os.path.basename(results_filename)] = {"size":file_stat.st_size,"mtime_ns":file_stat.st_mtime_ns,"sha1":file_fingerprint}
+
+def main():
+    args = parse_args()
+    index_directory = os.path.join(args.results_directory,".shrink_index")
+    os.makedirs(index_directory,exist_ok=True)
+    fingerprint_filename = os.path.join(index_directory,"fingerprints.json")
+    fingerprints = load_fingerprints(fingerprint_filename)
+
+    jobs = []
+    for results_file_name in sorted(os.listdir(args.results_directory)):
+        if not results_file_name.endswith(".output"):
+            continue
+        results_filename = os.path.join(args.results_directory,results_file_name)
+        if is_unchanged(results_filename,fingerprints.get(results_file_name)):
+            continue
+        dataset = get_dataset(results_file_name)
+        if dataset is None or is_shrunk(results_filename):
+            # nothing to do for this file until it changes
+            record_fingerprint(fingerprints,results_filename,get_file_fingerprint(results_filename))
+            continue
+        jobs.append((results_filename,dataset))
+
+    index_filenames = dict()
+    for dataset in sorted(set([dataset for results_filename, dataset in jobs])):
+        try:
+            index_filenames[dataset] = build_index(args.stimuli_directory,index_directory,dataset)
+        except:
+            print("Cannot build index for {0} from {1}".format(dataset,stimulus_tables[dataset]["file"]))
+
+    jobs = [(results_filename,dataset) for results_filename, dataset in jobs if dataset in index_filenames]
+    num_shrunk = 0
+    if jobs:
+        with ProcessPoolExecutor(max_workers=max(1,min(args.num_workers,len(jobs))),mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = {executor.submit(shrink_results_file,results_filename,dataset,index_filenames[dataset]):results_filename for results_filename, dataset in jobs}
+            for future in as_completed(futures):
+                try:
+                    file_fingerprint, num_rows, num_dropped = future.result()
+                    record_fingerprint(fingerprints,futures[future],file_fingerprint)
+                    num_shrunk += 1
+                    print("{0}: dropped {1} of {2} rows that are not in the stimulus table".format(os.path.basename(futures[future]),num_dropped,num_rows))
+                except:
+                    print("Cannot shrink results file {0}".format(os.path.basename(futures[future])))
+
+    save_fingerprints(fingerprint_filename,fingerprints)
+    print("Shrunk {0} results files".format(num_shrunk))
+
+if __name__ == "__main__":
+    main()
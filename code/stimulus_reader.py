@@ -0,0 +1,73 @@
+import hashlib
+
+# Reads stimulus files lazily, as documents (groups of consecutive lines that share context,
+# such as the lines of a document-level stimulus file that each add one more word) that are
+# never split between blocks or shards, so that the output of a sharded run is the same as
+# that of a run over the whole file.
+
+def clean_stimulus(stimulus):
+    return stimulus.replace("\\n","\n").replace("\\r","\r").replace("\\t","\t").replace('\"','"').replace("\'","'")
+
+def get_full_sentence(stimulus):
+    # the FullSentence field of an output row for a (cleaned) stimulus
+    return stimulus.replace("*","").replace("\n","\\n").replace("\r","\\r").replace("\t","\\t").replace('"','\"').replace("'","\'")
+
+def parse_shard(shard):
+    # '--shard i/N' selects the i-th (from 1) of N shards
+    shard_index, num_shards = [int(part) for part in shard.split("/")]
+    assert 1<=shard_index<=num_shards
+    return shard_index, num_shards
+
+def get_stimulus_file_hash(stimulus_filename):
+    stimulus_hash = hashlib.sha1()
+    with open(stimulus_filename,'r') as f:
+        for chunk in iter(lambda:f.read(1024*1024),""):
+            stimulus_hash.update(chunk.encode("utf-8"))
+    return stimulus_hash.hexdigest()
+
+def read_stimulus_lines(stimulus_filename):
+    # the same lines as f.read().splitlines(), without reading the whole file at once
+    line_idx = 0
+    with open(stimulus_filename,'r') as f:
+        for line in f:
+            for stimulus in line.splitlines():
+                yield line_idx, stimulus
+                line_idx += 1
+
+def continues_document(stimulus,previous_stimulus):
+    # a line continues the document of the previous line if its preceding context starts with
+    # the previous line up to the end of its target words (the next word of a document) or
+    # with the previous line's preceding context (another target after the same context)
+    context = stimulus.split("*")[0]
+    previous_context = previous_stimulus.split("*")[0].rstrip()
+    previous_prefix = "".join(previous_stimulus.split("*")[:2]).rstrip()
+    return (previous_context!="" and context.startswith(previous_context)) or (previous_prefix!="" and context.startswith(previous_prefix))
+
+def read_stimulus_documents(stimulus_filename,shard=None):
+    # yields the documents of a stimulus file as lists of (line index, stimulus); with a shard
+    # (i, N), only every N-th document, starting from the i-th, is yielded
+    document_idx = 0
+    document = []
+    for line_idx, stimulus in read_stimulus_lines(stimulus_filename):
+        if document and not continues_document(stimulus,document[-1][1]):
+            if shard is None or document_idx%shard[1]==shard[0]-1:
+                yield document
+            document_idx += 1
+            document = []
+        document.append((line_idx,stimulus))
+    if document and (shard is None or document_idx%shard[1]==shard[0]-1):
+        yield document
+
+def read_stimulus_blocks(stimulus_filename,block_size,shard=None):
+    # yields blocks (lists of documents) of at least block_size lines (except the last)
+    block = []
+    num_lines = 0
+    for document in read_stimulus_documents(stimulus_filename,shard):
+        block.append(document)
+        num_lines += len(document)
+        if num_lines>=block_size:
+            yield block
+            block = []
+            num_lines = 0
+    if block:
+        yield block
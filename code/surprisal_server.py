@@ -0,0 +1,225 @@
+import os
+import sys
+import json
+import math
+import argparse
+import asyncio
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import calculate_surprisal
+
+# Serves surprisals (and the other metrics) from models that are loaded once and kept in memory,
+# over localhost HTTP or a Unix socket. POST /score takes stimuli in the format of the .stims
+# files, either as a JSON object {"stimuli": [...], "model": ...} or as plain text with one
+# stimulus per line, and returns the fields of the .output rows of each stimulus for each model
+# (or only the requested one); GET /models lists the models. Requests that arrive within
+# batch_window milliseconds of each other are scored together, in batches of up to max_batch
+# stimuli. Options given after '--' (e.g. -- --precision bfloat16 -cpu) are passed on to
+# calculate_surprisal.py.
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serves surprisals from language models that \
+                                    are kept loaded between requests')
+
+    parser.add_argument('--model','-m', type=str,
+                        help='select a model to serve')
+    parser.add_argument('--model_list','-mm', type=str, default='model_list.txt',
+                        help='path to file with a list of models to serve (default is model_list.txt)')
+    parser.add_argument('--task', '-t', type=str, default='surprisal',
+                        help='metric to caclulate (default is surprisal)')
+    parser.add_argument('--task_list', '-tt', type=str,
+                        help='path to file with list of metrics to caclulate')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='host to serve HTTP on (default is 127.0.0.1)')
+    parser.add_argument('--port', '-pt', type=int, default=8765,
+                        help='port to serve HTTP on (default is 8765)')
+    parser.add_argument('--socket', '-s', type=str,
+                        help='path of a Unix socket to serve HTTP on instead of a port')
+    parser.add_argument('--batch_window', '-bw', type=float, default=5,
+                        help='milliseconds to wait for other requests to score together with the first one (default is 5)')
+    parser.add_argument('--max_batch', '-mb', type=int, default=32,
+                        help='maximum number of stimuli scored together (default is 32)')
+
+    argv = sys.argv[1:]
+    surprisal_argv = []
+    if "--" in argv:
+        argv, surprisal_argv = argv[:argv.index("--")], argv[argv.index("--")+1:]
+    args = parser.parse_args(argv)
+    return args, surprisal_argv
+
+def get_surprisal_arg_dict(args,surprisal_argv):
+    # the options of calculate_surprisal.py, which requires stimuli and an output directory
+    # even though neither is used here
+    surprisal_args = ["-o",tempfile.gettempdir(),"-i",os.devnull]
+    surprisal_args += ["-m",args.model] if args.model else ["-mm",args.model_list]
+    surprisal_args += ["-tt",args.task_list] if args.task_list else ["-t",args.task]
+    arg_dict = calculate_surprisal.process_args(calculate_surprisal.parse_args(surprisal_args+surprisal_argv))
+    if arg_dict:
+        arg_dict["batch_size"] = args.max_batch
+        arg_dict["token_cache"] = None
+    return arg_dict
+
+def load_models(arg_dict):
+    models = dict()
+    for model_name in arg_dict["model_list"]:
+        try:
+            tokenizer = calculate_surprisal.load_tokenizer(model_name)
+            model, model_type = calculate_surprisal.load_model(model_name,arg_dict["model_revision_list"][0],arg_dict)
+        except:
+            print("Cannot load model {0}".format(model_name))
+            continue
+        reversed_tokenizer, tokenizer_hash = calculate_surprisal.get_tokenizer_vocabulary(tokenizer)
+        models[model_name] = {"model":model,"tokenizer":tokenizer,"model_type":model_type,"reversed_tokenizer":reversed_tokenizer,
+                              "tokenizer_hash":tokenizer_hash,"scoring_state":dict(),"queue":asyncio.Queue()}
+        print("Loaded {0} ({1})".format(model_name,model_type))
+    return models
+
+def get_json_number(value):
+    # NaN (e.g. a metric of a stimulus without target tokens) is not valid JSON, so it is null
+    value = float(value)
+    return None if math.isnan(value) else value
+
+def get_response_row(output_fields,metric_values,metric_dict):
+    # the fields of an .output row, with the metrics as numbers (or lists of numbers)
+    response_row = dict(output_fields)
+    for metric in metric_dict:
+        if calculate_surprisal.metric_definitions[metric]["aggregation"]=="list":
+            response_row[calculate_surprisal.get_metric_name(metric)] = [get_json_number(value) for value in metric_values[metric]]
+        else:
+            response_row[calculate_surprisal.get_metric_name(metric)] = get_json_number(calculate_surprisal.aggregate_metric_values(metric,metric_values[metric]))
+    return response_row
+
+def score_batch(model_entry,stimulus_list,arg_dict):
+    # runs in the scoring thread; stimuli that cannot be scored get None
+    model, tokenizer, model_type = model_entry["model"], model_entry["tokenizer"], model_entry["model_type"]
+    encoded_stimuli = calculate_surprisal.get_encoded_stimuli(stimulus_list,tokenizer,model_entry["reversed_tokenizer"],model_entry["tokenizer_hash"],None,memory_cache=False)
+    metric_dict = {metric:[] for metric in arg_dict["standard_metric_list"]}
+    stimulus_metric_values = calculate_surprisal.score_stimuli(model,tokenizer,model_type,encoded_stimuli,range(len(encoded_stimuli)),
+                                                               metric_dict,arg_dict,model_entry["scoring_state"])
+    max_length = calculate_surprisal.get_max_length(model,tokenizer)
+    response_rows = []
+    for j in range(len(encoded_stimuli)):
+        try:
+            output_fields = calculate_surprisal.get_output_fields(encoded_stimuli[j],tokenizer,model_type,max_length,arg_dict)
+            response_rows.append(get_response_row(output_fields,stimulus_metric_values[j],metric_dict))
+        except:
+            response_rows.append(None)
+    return response_rows
+
+async def run_batcher(model_entry,arg_dict,args,executor):
+    # takes the first waiting request and any others that arrive within the batch window (up
+    # to max_batch stimuli), and scores all of their stimuli at once
+    loop = asyncio.get_running_loop()
+    queue = model_entry["queue"]
+    while True:
+        requests = [await queue.get()]
+        deadline = loop.time()+args.batch_window/1000
+        while sum([len(stimulus_list) for stimulus_list, future in requests])<args.max_batch:
+            try:
+                requests.append(await asyncio.wait_for(queue.get(),max(0,deadline-loop.time())))
+            except asyncio.TimeoutError:
+                break
+        stimulus_list = [stimulus for request_stimuli, future in requests for stimulus in request_stimuli]
+        try:
+            response_rows = await loop.run_in_executor(executor,score_batch,model_entry,stimulus_list,arg_dict)
+        except Exception as e:
+            for request_stimuli, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+        start = 0
+        for request_stimuli, future in requests:
+            if not future.done():
+                future.set_result(response_rows[start:start+len(request_stimuli)])
+            start += len(request_stimuli)
+
+async def score_request(models,body,content_type):
+    if "json" in content_type:
+        request = json.loads(body.decode("utf-8"))
+        stimulus_list = request["stimuli"]
+        model_names = request.get("models",[request["model"]] if "model" in request else list(models))
+        if not isinstance(model_names,list) or not all([isinstance(model_name,str) for model_name in model_names]):
+            return 400, {"error":"Expected 'models' as a list of model names and 'model' as a model name"}
+    else:
+        stimulus_list = body.decode("utf-8").splitlines()
+        model_names = list(models)
+    assert stimulus_list and all([isinstance(stimulus,str) for stimulus in stimulus_list])
+    unknown_models = [model_name for model_name in model_names if not model_name in models]
+    if unknown_models:
+        return 404, {"error":"Unknown models: {0}".format(", ".join(unknown_models))}
+
+    loop = asyncio.get_running_loop()
+    futures = []
+    for model_name in model_names:
+        future = loop.create_future()
+        await models[model_name]["queue"].put((stimulus_list,future))
+        futures.append(future)
+    results = await asyncio.gather(*futures)
+    return 200, {"results":{model_names[k]:results[k] for k in range(len(model_names))}}
+
+async def handle_connection(reader,writer,models,arg_dict):
+    # a minimal HTTP/1.1 server, closing the connection after each response
+    try:
+        method, path = (await reader.readline()).decode("latin-1").split()[:2]
+        headers = dict()
+        while True:
+            line = await reader.readline()
+            if line in [b"\r\n",b"\n",b""]:
+                break
+            name, value = line.decode("latin-1").split(":",1)
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length",0)))
+        if method=="GET" and path=="/models":
+            status, response = 200, {"models":list(models),"metrics":[calculate_surprisal.get_metric_name(metric) for metric in arg_dict["standard_metric_list"]]}
+        elif method=="POST" and path=="/score":
+            try:
+                status, response = await score_request(models,body,headers.get("content-type",""))
+            except (ValueError,KeyError,AssertionError):
+                status, response = 400, {"error":"Expected stimuli as a JSON object with a 'stimuli' list, or as plain text with one stimulus per line"}
+        else:
+            status, response = 404, {"error":"Use POST /score or GET /models"}
+    except Exception as e:
+        status, response = 500, {"error":str(e)}
+
+    payload = json.dumps(response).encode("utf-8")
+    reasons = {200:"OK",400:"Bad Request",404:"Not Found",500:"Internal Server Error"}
+    try:
+        writer.write("HTTP/1.1 {0} {1}\r\nContent-Type: application/json\r\nContent-Length: {2}\r\nConnection: close\r\n\r\n".format(
+            status,reasons[status],len(payload)).encode("latin-1")+payload)
+        await writer.drain()
+        writer.close()
+    except ConnectionError:
+        pass
+
+async def serve(args,arg_dict):
+    models = load_models(arg_dict)
+    if not models:
+        print("Error: No models could be loaded")
+        return
+    # the models are run from a single thread, one batch at a time
+    executor = ThreadPoolExecutor(max_workers=1)
+    batchers = [asyncio.create_task(run_batcher(models[model_name],arg_dict,args,executor)) for model_name in models]
+    handler = lambda reader, writer: handle_connection(reader,writer,models,arg_dict)
+    if args.socket:
+        server = await asyncio.start_unix_server(handler,path=args.socket)
+        print("Serving {0} models on {1}".format(len(models),args.socket))
+    else:
+        server = await asyncio.start_server(handler,host=args.host,port=args.port)
+        print("Serving {0} models on http://{1}:{2}".format(len(models),args.host,args.port))
+    async with server:
+        await server.serve_forever()
+
+def main():
+    args, surprisal_argv = parse_args()
+    arg_dict = get_surprisal_arg_dict(args,surprisal_argv)
+    if arg_dict:
+        try:
+            asyncio.run(serve(args,arg_dict))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if args.socket and os.path.exists(args.socket):
+                os.remove(args.socket)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import os
+import csv
+import json
+import hashlib
+import argparse
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Refreshes all_AICs.tsv from the results files on a single machine. The regressions are the
+# same as in run_analyses.R and are fitted by fit_surprisal_models.R, which reads and prepares
+# each dataset once for all of the results files it is given; the results files of each
+# analysis are split between up to num_workers Rscript processes run at the same time. The AICs
+# are cached by the fingerprint of each results file (and of the fitting script and the dataset
+# loaders it shares with run_analyses.R), so that only new or changed results files are fitted
+# again.
+
+# analyses, and the results files they use (as in run_analyses.R)
+analyses = {
+    "michaelov":"michaelov",
+    "szewczyk":"szewczyk",
+    "brothers":"brothers",
+    "luke":"luke_2018_dl",
+    "boyce":"futrell_2018_dl",
+    "futrell":"futrell_2018_dl",
+    "kennedy":"kennedy",
+    "smith":"smith_2013",
+}
+
+output_columns = ["Dataset","ModelName","ModelArchitecture","ModelSize","Surprisal_AIC"]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Fits the regressions of every analysis for every \
+                                    results file in parallel and saves their AICs')
+
+    parser.add_argument('--results_directory', '-r', type=str, default='../results',
+                        help='directory of results files (default is ../results)')
+    parser.add_argument('--output', '-o', type=str, default='all_AICs.tsv',
+                        help='path of the tsv file to save the AICs to (default is all_AICs.tsv)')
+    parser.add_argument('--analyses', '-a', type=str, default=",".join(analyses),
+                        help='comma-separated analyses to run (default is all of them)')
+    parser.add_argument('--num_workers', '-w', type=int, default=os.cpu_count(),
+                        help='number of Rscript processes to run at the same time (default is the number of CPUs)')
+    parser.add_argument('--cache', '-c', type=str, default='.aic_cache.json',
+                        help='path of the cache of fitted AICs (default is .aic_cache.json)')
+    parser.add_argument('--rscript', type=str, default='Rscript',
+                        help='Rscript executable to fit the regressions with (default is Rscript)')
+
+    args = parser.parse_args()
+    return args
+
+def get_file_fingerprint(filename):
+    file_hash = hashlib.sha1()
+    with open(filename,"rb") as f:
+        for chunk in iter(lambda:f.read(1024*1024),b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def get_cache_key(analysis,results_file_name,results_fingerprint,script_fingerprint):
+    # the model name comes from the file name, and the regressions from the fitting script and
+    # the dataset loaders
+    return "\t".join([analysis,results_file_name,results_fingerprint,script_fingerprint])
+
+def load_cache(cache_filename):
+    try:
+        with open(cache_filename,"r") as f:
+            return json.load(f)
+    except:
+        return dict()
+
+def save_cache(cache_filename,cache):
+    with open(cache_filename+".tmp","w") as f:
+        json.dump(cache,f,indent=1,sort_keys=True)
+    os.replace(cache_filename+".tmp",cache_filename)
+
+def run_fitting_job(analysis,results_filenames,script_filename,rscript):
+    # returns the rows written by fit_surprisal_models.R, which runs from the statistics folder
+    # so that its paths to the datasets are the same as those of run_analyses.R
+    with tempfile.TemporaryDirectory() as work_directory:
+        output_filename = os.path.join(work_directory,analysis+".tsv")
+        subprocess.run([rscript,os.path.basename(script_filename),analysis,output_filename]+results_filenames,
+                       cwd=os.path.dirname(script_filename),check=True)
+        with open(output_filename,"r",newline="") as f:
+            return list(csv.DictReader(f,delimiter="\t"))
+
+def main():
+    args = parse_args()
+    script_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),"fit_surprisal_models.R")
+    loader_filename = os.path.join(os.path.dirname(script_filename),"load_datasets.R")
+    script_fingerprint = get_file_fingerprint(script_filename)+get_file_fingerprint(loader_filename)
+    cache = load_cache(args.cache)
+
+    # each results file is read once to fingerprint it; only those of the selected analyses that
+    # are not in the cache are passed on to be fitted
+    selected_analyses = args.analyses.split(",")
+    cache_keys = dict()
+    pending = dict()
+    for results_file_name in sorted(os.listdir(args.results_directory)):
+        if not results_file_name.endswith(".output"):
+            continue
+        results_filename = os.path.abspath(os.path.join(args.results_directory,results_file_name))
+        results_fingerprint = None
+        for analysis in analyses:
+            if analyses[analysis] in results_file_name:
+                if results_fingerprint is None:
+                    results_fingerprint = get_file_fingerprint(results_filename)
+                cache_key = get_cache_key(analysis,results_file_name,results_fingerprint,script_fingerprint)
+                cache_keys[(analysis,results_filename)] = cache_key
+                if analysis in selected_analyses and not cache_key in cache:
+                    pending.setdefault(analysis,[]).append(results_filename)
+
+    # the results files of each analysis are split between as many jobs as there are workers,
+    # each of which prepares the dataset once
+    jobs = []
+    for analysis in pending:
+        num_jobs = max(1,min(args.num_workers,len(pending[analysis])))
+        for job_idx in range(num_jobs):
+            jobs.append((analysis,pending[analysis][job_idx::num_jobs]))
+    # the Rscript processes do the work, so threads are enough to wait on them
+    with ThreadPoolExecutor(max_workers=max(1,args.num_workers)) as executor:
+        futures = {executor.submit(run_fitting_job,analysis,results_filenames,script_filename,args.rscript):(analysis,results_filenames)
+                   for analysis, results_filenames in jobs}
+        for future in as_completed(futures):
+            analysis, results_filenames = futures[future]
+            try:
+                rows = future.result()
+            except:
+                print("Cannot fit {0} regressions for {1} results files".format(analysis,len(results_filenames)))
+                continue
+            for results_filename in results_filenames:
+                statuses = [row["Status"] for row in rows if row["ResultsFile"]==results_filename]
+                # files that failed (or have no output) are fitted again next time
+                if not statuses or "failed" in statuses:
+                    print("Cannot fit {0} regression for {1}".format(analysis,os.path.basename(results_filename)))
+                    continue
+                cache[cache_keys[(analysis,results_filename)]] = [{column:row[column] for column in output_columns}
+                                                                  for row in rows if row["ResultsFile"]==results_filename and row["Status"]=="fitted"]
+            save_cache(args.cache,cache)
+
+    # only the AICs of the current results files are kept
+    cache = {cache_key:cache[cache_key] for cache_key in cache_keys.values() if cache_key in cache}
+    save_cache(args.cache,cache)
+    all_AICs = sorted([row for cache_key in sorted(cache) for row in cache[cache_key]],key=lambda row:(row["Dataset"],row["ModelName"]))
+    with open(args.output+".tmp","w") as f:
+        f.write("\t".join(output_columns)+"\n")
+        for row in all_AICs:
+            f.write("\t".join([row[column] for column in output_columns])+"\n")
+    os.replace(args.output+".tmp",args.output)
+    print("Saved {0} AICs ({1} results files fitted)".format(len(all_AICs),sum([len(results_filenames) for analysis, results_filenames in jobs])))
+
+if __name__ == "__main__":
+    main()